@@ -2,3 +2,8 @@
 
 from . import controllers
 from . import models
+
+
+def post_init_hook(env):
+    env['res.users']._rebuild_referral_paths()
+    env['user.commission.entry']._rebuild_commission_ledger()
@@ -16,7 +16,7 @@ Long description of module's purpose
     # Check https://github.com/odoo/odoo/blob/15.0/odoo/addons/base/data/ir_module_category_data.xml
     # for the full list
     'category': 'Uncategorized',
-    "version": "11.10.25",
+    "version": "11.10.34",
 
     # any module necessary for this one to work correctly
     'depends': ['base', 'web','website', 'sale', 'sale_management', 'mail', 'portal', 'payment','website_sale_dashboard','account','loyalty'],
@@ -26,6 +26,7 @@ Long description of module's purpose
         'groups/groups.xml',
         'security/ir.model.access.csv',
         'data/commission_cron.xml',
+        'data/commission_slice_version_data.xml',
         'views/registration_template.xml',
         'views/thank_you_template.xml',
         'views/res_users.xml',
@@ -34,6 +35,7 @@ Long description of module's purpose
         'views/team_registration_views.xml',
         'views/commission_slices_views.xml',
         'views/coach_commission_period.xml',
+        'views/user_commission_entry_views.xml',
         'views/team_registration_menu.xml',
         'views/website_home_page.xml',
         'views/portal_my_team_template.xml',
@@ -54,6 +56,7 @@ Long description of module's purpose
         
     ],
 },
+    'post_init_hook': 'post_init_hook',
     'license': 'LGPL-3',
     'application': True,
 }
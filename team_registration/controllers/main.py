@@ -1,7 +1,8 @@
 from odoo import http, _
 from odoo.http import request
-import base64
+import hashlib
 from werkzeug.urls import url_encode
+from werkzeug.http import http_date
 from odoo.exceptions import UserError
 from odoo.addons.auth_signup.models.res_users import SignupError
 from markupsafe import Markup
@@ -9,7 +10,10 @@ import werkzeug
 import logging
 from datetime import timedelta
 from odoo import fields
-from odoo.addons.portal.controllers.portal import CustomerPortal
+from odoo.addons.portal.controllers.portal import CustomerPortal, pager as portal_pager
+from odoo.addons.team_registration.models.res_users import TEAM_PAGE_ORDERS, format_national_phone, normalize_phone
+from odoo.addons.team_registration.models.team_registration import CERT_MAX_SIZE
+from psycopg2.errors import UniqueViolation
 from odoo.addons.web.controllers.home import Home
 
 _logger = logging.getLogger(__name__)
@@ -40,44 +44,63 @@ class MyPortalHome(CustomerPortal):
     def home(self, **kw):
 
         user = request.env.user.sudo()
-        
-        # Only show commission data for coaches
-        track = None
-        if user.is_coach:
-            track = request.env['user.commission.track'].sudo().search([
-                ('user_id', '=', user.id),
-                ('status', '=', 'active')
-            ], limit=1)
+
+        # Only show commission data for coaches, from the stored active track
+        # of the coach: no search and no write on this page
+        track = user.commission_active_track_id if user.is_coach else None
 
         # Get wallet balance from loyalty card
-        wallet_balance = 0.0
-        program = request.env['loyalty.program'].sudo().search([('program_type', '=', 'ewallet')], limit=1)
-        card = False
-        if program:
-            card = request.env['loyalty.card'].sudo().search([
-                ('partner_id', '=', user.partner_id.id),
-                ('program_id', '=', program.id)
-            ], limit=1)
-            if card:
-                wallet_balance = card.points or 0.0
-        
-        # Force refresh of current balance to ensure we have latest values
-        if track:
-            track.refresh_current_balance()
+        card = request.env['loyalty.card']._get_wallet_cards([user.partner_id.id]).get(user.partner_id.id)
+        wallet_balance = card.points or 0.0 if card else 0.0
+
+        etag, last_modified = self._get_home_cache_validators(user, track, card)
+        conditional = request.httprequest
+        if etag in conditional.if_none_match or (
+                not conditional.if_none_match
+                and conditional.if_modified_since
+                and last_modified <= conditional.if_modified_since.replace(tzinfo=None)):
+            response = request.make_response('', status=304)
+        else:
+            values = {
+                'user_id': user,
+                'track': track,
+                'commission_rate': track.commission_rate or 0.0 if track else 0.0,
+                'commission': track.commission or 0.0 if track else 0.0,
+                'direct_purchase': track.direct_purchase or 0.0 if track else 0.0,
+                'indirect_purchase': track.indirect_purchase or 0.0 if track else 0.0,
+                'total_purchase': track.total_purchase or 0.0 if track else 0.0,
+                'currency': track.currency_id or request.env.company.currency_id if track else request.env.company.currency_id,
+                'current_balance' : user.commission_balance or 0.0 if track else 0.0,
+                'wallet_balance': wallet_balance,
+            }
+            response = request.render("portal.portal_my_home", values)
+        response.set_etag(etag)
+        response.headers['Last-Modified'] = http_date(last_modified)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
 
-        values = {
-            'user_id': user,
-            'track': track,
-            'commission_rate': track.commission_rate or 0.0 if track else 0.0,
-            'commission': track.commission or 0.0 if track else 0.0,
-            'direct_purchase': track.direct_purchase or 0.0 if track else 0.0,
-            'indirect_purchase': track.indirect_purchase or 0.0 if track else 0.0,
-            'total_purchase': track.total_purchase or 0.0 if track else 0.0,
-            'currency': track.currency_id or request.env.company.currency_id if track else request.env.company.currency_id,
-            'current_balance' : track.current_balance or 0.0 if track else 0.0,
-            'wallet_balance': wallet_balance,
-        }
-        return request.render("portal.portal_my_home", values)
+    def _get_home_cache_validators(self, user, track, card):
+        """Return the ``(etag, last_modified)`` of the portal home of ``user``.
+
+        The page only changes with the snapshot stamp of the active track,
+        the commission balance, the wallet card, the user and the session
+        (CSRF token, language, cart), so these are all the ETag is made of.
+        A transfer changes the balance and credits the wallet card, whose
+        write date moves, so the balance needs no stamp of its own.
+        """
+        stamps = [
+            user.write_date,
+            user.partner_id.write_date,
+            track.snapshot_date if track else None,
+            card.write_date if card else None,
+        ]
+        last_modified = max(stamp for stamp in stamps if stamp).replace(microsecond=0)
+        key = repr((
+            user.id, track.snapshot_version if track else None, user.commission_balance, stamps,
+            request.session.sid, request.lang.code,
+            request.session.get('website_sale_cart_quantity'),
+        ))
+        return hashlib.sha1(key.encode()).hexdigest(), last_modified
 
 
 class WebsiteTeamRegistration(http.Controller):
@@ -89,19 +112,22 @@ class WebsiteTeamRegistration(http.Controller):
     @http.route(['/team/submit/create'], type='http', auth='public', website=True, csrf=False)
     def create_form(self, **post):
         file_data = post.get('cert_file')
-        cert_encoded = False
-        filename = False
+        file_content = False
         if file_data:
-            file_content = file_data.read()
-            cert_encoded = base64.b64encode(file_content)
-            filename = file_data.filename
+            # Never read more than the cap, the rest of the upload stays in
+            # werkzeug's spooled temporary file
+            file_content = file_data.read(CERT_MAX_SIZE + 1)
+            if len(file_content) > CERT_MAX_SIZE:
+                return request.render('team_registration.team_form_template', {
+                    'referrer_id': post.get('referrer_id'),
+                    'error': _("The certificate cannot be larger than %s MB.", CERT_MAX_SIZE // (1024 * 1024)),
+                })
 
         email = post.get('email')
-        phone = post.get('phone')
-        full_phone = '+962' + phone if phone else False
+        full_phone = format_national_phone(post.get('phone'))
 
-        existing = request.env['team.registration'].sudo().search([
-            ('phone', '=', full_phone)
+        existing = full_phone and request.env['team.registration'].sudo().search_count([
+            ('phone_normalized', '=', normalize_phone(full_phone))
         ], limit=1)
 
         if existing:
@@ -110,21 +136,28 @@ class WebsiteTeamRegistration(http.Controller):
         referrer_id = post.get('referrer_id')
         referred_user = int(referrer_id) if referrer_id and referrer_id.isdigit() else None
 
-        request.env['team.registration'].sudo().create({
-            'name': post.get('full_name'),
-            'phone': full_phone,
-            'email': email,
-            'password': post.get('password'),
-            'role': post.get('role'),
-            'years_experience': post.get('experience'),
-            'fitness_center': post.get('center'),
-            'city': post.get('city'),
-            'address': post.get('address'),
-            'degree': post.get('degree'),
-            'cert_file': cert_encoded,
-            'cert_filename': filename,
-            'referred_by': referred_user,
-        })
+        try:
+            with request.env.cr.savepoint():
+                registration = request.env['team.registration'].sudo().create({
+                    'name': post.get('full_name'),
+                    'phone': full_phone,
+                    'email': email,
+                    'password': post.get('password'),
+                    'role': post.get('role'),
+                    'years_experience': post.get('experience'),
+                    'fitness_center': post.get('center'),
+                    'city': post.get('city'),
+                    'address': post.get('address'),
+                    'degree': post.get('degree'),
+                    'referred_by': referred_user,
+                })
+                if file_content:
+                    registration._attach_certificate(file_data.filename, file_content)
+        except UniqueViolation as e:
+            # Same phone submitted concurrently, the unique index decided
+            if e.diag.constraint_name != 'team_registration_phone_normalized_uniq':
+                raise
+            return request.redirect('/user-exists')
 
         return request.redirect('/thank-you')
 
@@ -168,7 +201,6 @@ class WebsiteTeamRegistration(http.Controller):
             raise UserError("Passwords do not match.")
         values['lang'] = request.context.get('lang', 'en_US')
         self._signup_with_values(qcontext.get('token'), values)
-        request.env.cr.commit()
 
     @http.route('/web/signup', type='http', auth='public', website=True, sitemap=False)
     def web_auth_signup(self, *args, **kw):
@@ -196,12 +228,16 @@ class WebsiteTeamRegistration(http.Controller):
                     public_user = request.env.ref('base.public_user')
                     request.update_env(user=public_user)
 
-                # Email notification
+                # Email notification, queued: the mail cron talks to the
+                # SMTP server, not this request
                 user = request.env['res.users'].sudo().search([('login', '=', qcontext.get('login'))], limit=1)
                 template = request.env.ref('auth_signup.mail_template_user_signup_account_created',
                                            raise_if_not_found=False)
                 if user and template:
-                    template.sudo().send_mail(user.id, force_send=True)
+                    template.sudo().send_mail(user.id)
+                    mail_cron = request.env.ref('mail.ir_cron_mail_scheduler_action', raise_if_not_found=False)
+                    if mail_cron:
+                        mail_cron.sudo()._trigger()
 
                 return request.redirect('/shop')
 
@@ -224,50 +260,39 @@ class WebsiteTeamRegistration(http.Controller):
             values['referral_link'] = referral_link
 
         login, password = request.env['res.users'].sudo().signup(values, token)
+        # The only commit of the signup: authenticate() checks the password
+        # on its own cursor, the new user must be visible there
         request.env.cr.commit()
 
         request.session.authenticate(request.db, {'type': 'password', 'login': login, 'password': password})
 
-    @http.route('/my/team', type='http', auth='user', website=True)
-    def my_team(self):
-        user = request.env.user
-        members = user.referred_users.sudo()
-        Invoice = request.env['account.move'].sudo()
-        CommissionTrack = request.env['user.commission.track'].sudo()
-
-        # Get all closed tracks for this user
-        closed_tracks = CommissionTrack.search([
-            ('user_id', '=', user.id),
-            ('status', '=', 'closed')
-        ])
-
-        # Prepare a dictionary to accumulate team purchase per member
-        member_totals = {m.id: 0.0 for m in members}
-
-        for track in closed_tracks:
-            start_date = track.start_date
-            close_date = track.close_date
-
-            for m in members:
-                invoices = Invoice.search([
-                    ('move_type', '=', 'out_invoice'),
-                    ('state', '=', 'posted'),
-                    ('partner_id', '=', m.partner_id.id),
-                    ('payment_state', 'in', ['paid', 'in_payment']),
-                    ('invoice_date', '>=', start_date),
-                    ('invoice_date', '<=', close_date),
-                ])
-                # Sum without tax
-                member_totals[m.id] += sum(inv.amount_untaxed for inv in invoices)
+    @http.route(['/my/team', '/my/team/page/<int:page>'], type='http', auth='user', website=True)
+    def my_team(self, page=1, sortby='total_desc', **kw):
+        user = request.env.user.sudo()
+        if sortby not in TEAM_PAGE_ORDERS:
+            sortby = 'total_desc'
+
+        step = 20
+        page = max(int(page), 1)
+        member_count, rows = user._read_team_purchase_page(
+            order=sortby, limit=step, offset=(page - 1) * step)
+        pager = portal_pager(
+            url='/my/team',
+            url_args={'sortby': sortby},
+            total=member_count,
+            page=page,
+            step=step,
+        )
 
         # Prepare data for the template
+        members = request.env['res.users'].sudo().browse([member_id for member_id, _total in rows])
         team_data = []
-        for m in members:
+        for m, (_member_id, total) in zip(members, rows):
             team_data.append({
                 'name': m.name,
                 'email': m.email,
-                'mobile':m.mobile,
-                'total_purchase': round(member_totals[m.id], 2),
+                'mobile': m.mobile,
+                'total_purchase': round(total, 2),
             })
 
         currency = request.env.company.currency_id
@@ -275,6 +300,8 @@ class WebsiteTeamRegistration(http.Controller):
         return request.render('team_registration.portal_my_team_template', {
             'team_data': team_data,
             'currency': currency,
+            'pager': pager,
+            'sortby': sortby,
         })
 
 
@@ -312,28 +339,27 @@ class WebsiteTeamRegistration(http.Controller):
         ) or request.env['user.commission.track'].sudo().browse()
         
         # Get wallet balance from loyalty card
-        card = None
-        wallet_balance = 0.0
-        program = request.env['loyalty.program'].sudo().search([('program_type', '=', 'ewallet')], limit=1)
-        if program:
-            card = request.env['loyalty.card'].sudo().search([
-                ('partner_id', '=', user.partner_id.id),
-                ('program_id', '=', program.id)
-            ], limit=1)
-            if card:
-                wallet_balance = card.points or 0.0
+        card = request.env['loyalty.card']._get_wallet_cards([user.partner_id.id]).get(user.partner_id.id)
+        wallet_balance = card.points or 0.0 if card else 0.0
         
         # Calculate summary data (for all tracks, not just paginated ones)
-        all_tracks = request.env['user.commission.track'].sudo().search([('user_id', '=', user.id)]) or request.env['user.commission.track'].sudo().browse()
-        total_commission = sum(all_tracks.mapped('commission')) if all_tracks else 0.0
-        total_transferred = sum(all_tracks.mapped('commission_transferred')) if all_tracks else 0.0
+        [(total_commission, total_transferred)] = request.env['user.commission.track'].sudo()._read_group(
+            [('user_id', '=', user.id)], [], ['commission:sum', 'commission_transferred:sum'],
+        )
+        total_commission = total_commission or 0.0
+        total_transferred = total_transferred or 0.0
         available_balance = total_commission - total_transferred
         
-        # Loyalty history (only debits/used > 0)
-        loyalty_history = request.env['loyalty.history'].sudo().search([
-            ('card_id', '=', card.id if card else 0),
-            ('used', '>', 0)
-        ], order='id desc') if card else request.env['loyalty.history'].sudo().browse()
+        # Loyalty history (only debits/used > 0), newest first, keyset paged on id
+        history_before = int(kw.get('history_before') or 0)
+        history_domain = [('card_id', '=', card.id if card else 0), ('used', '>', 0)]
+        if history_before:
+            history_domain.append(('id', '<', history_before))
+        loyalty_history = request.env['loyalty.history'].sudo().search(
+            history_domain, order='id desc', limit=per_page + 1,
+        ) if card else request.env['loyalty.history'].sudo().browse()
+        history_next = loyalty_history[per_page - 1].id if len(loyalty_history) > per_page else None
+        loyalty_history = loyalty_history[:per_page]
 
         values = {
             'user_id': user,
@@ -352,5 +378,7 @@ class WebsiteTeamRegistration(http.Controller):
             'prev_page': page - 1 if page > 1 else None,
             'next_page': page + 1 if page < total_pages else None,
             'loyalty_history': loyalty_history,
+            'history_before': history_before,
+            'history_next': history_next,
         }
         return request.render('team_registration.portal_commission_details_template', values)
@@ -0,0 +1,103 @@
+"""Timers and counters for the commission code paths.
+
+Batch entry points (crons, queue, ledger sync) open a run with
+``commission_run`` or the ``instrumented`` method decorator, the code they
+call adds to it through ``current_run`` and one structured summary line is
+logged when the run ends::
+
+    commission run {"counters": {...}, "duration": 1.2, "queries": 42, ...}
+
+Per-record tracing goes through ``run.trace()`` and is only emitted when
+this logger is at DEBUG level or the ``team_registration.commission_trace``
+system parameter is set.
+"""
+import functools
+import json
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+_logger = logging.getLogger(__name__)
+
+TRACE_PARAM = 'team_registration.commission_trace'
+
+_local = threading.local()
+
+
+def is_tracing(env):
+    return _logger.isEnabledFor(logging.DEBUG) or bool(
+        env['ir.config_parameter'].sudo().get_param(TRACE_PARAM))
+
+
+class CommissionRun:
+    """Counters, timers and query count of one run."""
+
+    def __init__(self, name, env):
+        self.name = name
+        self.env = env
+        self.counters = Counter()
+        self.timers = defaultdict(float)
+        self._tracing = None
+        self._started = time.time()
+        self._queries = env.cr.sql_log_count
+
+    def incr(self, key, value=1):
+        self.counters[key] += value
+
+    @contextmanager
+    def timer(self, key):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timers[key] += time.time() - start
+
+    def trace(self, message, *args):
+        if self._tracing is None:
+            self._tracing = is_tracing(self.env)
+        if self._tracing:
+            _logger.info("%s: " + message, self.name, *args)
+
+    def summary(self):
+        return {
+            'run': self.name,
+            'duration': round(time.time() - self._started, 3),
+            'queries': self.env.cr.sql_log_count - self._queries,
+            'counters': {key: round(value, 2) for key, value in self.counters.items()},
+            'timers': {key: round(value, 3) for key, value in self.timers.items()},
+        }
+
+
+def current_run(env):
+    """Return the innermost open run, or a detached one whose figures are
+    simply dropped when no run is open."""
+    stack = getattr(_local, 'runs', None)
+    return stack[-1] if stack else CommissionRun('detached', env)
+
+
+@contextmanager
+def commission_run(env, name, level=logging.INFO):
+    """Open a run named ``name`` for the block and log its summary at
+    ``level`` when the block ends, even on error."""
+    run = CommissionRun(name, env)
+    stack = _local.__dict__.setdefault('runs', [])
+    stack.append(run)
+    try:
+        yield run
+    finally:
+        stack.pop()
+        if _logger.isEnabledFor(level):
+            _logger.log(level, "commission run %s", json.dumps(run.summary(), sort_keys=True))
+
+
+def instrumented(name, level=logging.INFO):
+    """Decorate a model method to run it inside ``commission_run``."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with commission_run(self.env, name, level):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,7 @@
+from odoo import api, SUPERUSER_ID
+
+
+def migrate(cr, version):
+    """Fill the referral paths of the existing users."""
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env['res.users']._rebuild_referral_paths()
@@ -0,0 +1,4 @@
+def migrate(cr, version):
+    """Existing registrations already got their approval activities, keep
+    them out of the first approval digest."""
+    cr.execute("UPDATE team_registration SET approval_notified = TRUE")
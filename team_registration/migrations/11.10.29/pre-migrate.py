@@ -0,0 +1,36 @@
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# SQL twin of ``normalize_phone``: digits only, without a leading "00"
+NORMALIZE = "NULLIF(regexp_replace(regexp_replace({column}, '\\D', '', 'g'), '^00', ''), '')"
+
+
+def _backfill(cr, table, source, where="TRUE"):
+    """Create and fill ``phone_normalized`` in plain SQL before the ORM
+    sees the field, so it does not recompute every row in Python. Only the
+    oldest row of a duplicated number keeps it, the unique constraint
+    could not be created otherwise."""
+    cr.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS phone_normalized varchar")
+    cr.execute(f"""
+        UPDATE {table}
+           SET phone_normalized = {NORMALIZE.format(column=source)}
+         WHERE {where}
+    """)
+    cr.execute(f"""
+        UPDATE {table} t
+           SET phone_normalized = NULL
+          FROM (SELECT id, row_number() OVER (PARTITION BY phone_normalized ORDER BY id) AS rank
+                  FROM {table}
+                 WHERE phone_normalized IS NOT NULL) dup
+         WHERE dup.id = t.id
+           AND dup.rank > 1
+    """)
+    if cr.rowcount:
+        _logger.warning("%s: %s rows share their phone number with an older one, left without normalized phone",
+                        table, cr.rowcount)
+
+
+def migrate(cr, version):
+    _backfill(cr, 'team_registration', 'phone')
+    _backfill(cr, 'res_users', 'login', r"login ~ '^\+?[\d\s()-]{7,}$'")
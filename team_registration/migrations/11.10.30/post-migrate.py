@@ -0,0 +1,33 @@
+from odoo import api, SUPERUSER_ID
+from odoo.tools.sql import column_exists
+import logging
+
+_logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+
+
+def migrate(cr, version):
+    """Move the certificates stored in the ``cert_file`` column to the
+    filestore, a batch of rows at a time, then drop the column."""
+    if not column_exists(cr, 'team_registration', 'cert_file'):
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    cr.execute("SELECT id FROM team_registration WHERE cert_file IS NOT NULL ORDER BY id")
+    ids = [row[0] for row in cr.fetchall()]
+    for start in range(0, len(ids), BATCH_SIZE):
+        cr.execute(
+            "SELECT id, cert_file FROM team_registration WHERE id IN %s",
+            [tuple(ids[start:start + BATCH_SIZE])],
+        )
+        env['ir.attachment'].create([{
+            'name': 'cert_file',
+            'res_model': 'team.registration',
+            'res_field': 'cert_file',
+            'res_id': registration_id,
+            'type': 'binary',
+            'datas': bytes(data),
+        } for registration_id, data in cr.fetchall()])
+        env.invalidate_all()
+    cr.execute("ALTER TABLE team_registration DROP COLUMN cert_file")
+    _logger.info("Moved %s registration certificates to the filestore", len(ids))
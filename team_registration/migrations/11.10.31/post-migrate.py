@@ -0,0 +1,14 @@
+from odoo import api, SUPERUSER_ID
+
+
+def migrate(cr, version):
+    """The existing slices go to the initial plan version, loaded with the
+    module data after their version column was created empty, and the
+    existing tracks point to their version too."""
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    initial = env.ref('team_registration.commission_slice_version_initial')
+    cr.execute("UPDATE commission_slices SET version_id = %s WHERE version_id IS NULL", [initial.id])
+    cr.execute("ALTER TABLE commission_slices ALTER COLUMN version_id SET NOT NULL")
+    env.registry.clear_cache()
+    tracks = env['user.commission.track'].search([('slice_version_id', '=', False)])
+    tracks._assign_slice_versions(recompute=False)
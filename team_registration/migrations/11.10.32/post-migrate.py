@@ -0,0 +1,4 @@
+def migrate(cr, version):
+    """The commission snapshot stamp moved from the coach to the tracks,
+    its columns go with the fields, drop the sequence that fed it."""
+    cr.execute("DROP SEQUENCE IF EXISTS res_users_commission_snapshot_seq")
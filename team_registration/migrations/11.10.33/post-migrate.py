@@ -0,0 +1,29 @@
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def _drop_trunk_prefix(cr, table):
+    """Drop the national trunk "0" kept after the country code by the
+    previous normalization. A number whose corrected form already exists
+    is left without normalized phone, like the duplicates of 11.10.29."""
+    cr.execute(f"""
+        UPDATE {table} t
+           SET phone_normalized = CASE
+                   WHEN EXISTS (SELECT 1 FROM {table} o
+                                 WHERE o.phone_normalized = '962' || substr(t.phone_normalized, 5))
+                   THEN NULL
+                   ELSE '962' || substr(t.phone_normalized, 5)
+               END
+         WHERE t.phone_normalized LIKE '9620%'
+     RETURNING t.phone_normalized
+    """)
+    dropped = sum(1 for normalized, in cr.fetchall() if normalized is None)
+    if dropped:
+        _logger.warning("%s: %s rows share their phone number with another one once normalized, "
+                        "left without normalized phone", table, dropped)
+
+
+def migrate(cr, version):
+    _drop_trunk_prefix(cr, 'team_registration')
+    _drop_trunk_prefix(cr, 'res_users')
@@ -0,0 +1,22 @@
+from odoo import api, release, SUPERUSER_ID
+from odoo.tools import parse_version
+
+# First version with the commission ledger
+LEDGER_VERSION = '11.10.26'
+
+
+def migrate(cr, version):
+    """Price the commission tracks once, after the previous migrations put
+    in place everything pricing reads: referral paths (11.10.27) and the
+    plan version of the slices and tracks (11.10.31).
+
+    Coming from before the ledger, it is built from the paid invoice
+    history, which recomputes the open tracks and closes the expired ones.
+    Otherwise the ledger is kept, with its reversals, and only the open
+    tracks are recomputed.
+    """
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    if parse_version(version) < parse_version('%s.%s' % (release.major_version, LEDGER_VERSION)):
+        env['user.commission.entry']._rebuild_commission_ledger()
+    else:
+        env['user.commission.track'].search([('status', '!=', 'closed')])._compute_purchases()
@@ -1,3 +1,3 @@
 # -*- coding: utf-8 -*-
 
-from . import team_registration, res_users, res_company, commission_slices, sale_order, user_commission_track, account_move
+from . import team_registration, res_users, res_company, commission_slice_version, commission_slices, sale_order, user_commission_track, user_commission_entry, user_commission_queue, account_move, loyalty, user_commission_topup
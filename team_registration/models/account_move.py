@@ -2,105 +2,130 @@ from odoo import models, fields, api
 from datetime import timedelta
 import logging
 
+from ..metrics import current_run
+
 _logger = logging.getLogger(__name__)
 
+# Fields whose change can add, remove or alter a commission ledger entry
+COMMISSION_LEDGER_FIELDS = ('state', 'payment_state', 'partner_id', 'invoice_date', 'amount_untaxed')
+
+
 class AccountMove(models.Model):
     _inherit = 'account.move'
 
-    @api.model
+    def _compute_payment_state(self):
+        super()._compute_payment_state()
+        self.filtered(lambda move: move.move_type == 'out_invoice')._commission_mark_dirty()
+
+    def _commission_mark_dirty(self):
+        """Flag these moves so that their commission ledger entries are
+        synced once, right before the transaction commits."""
+        move_ids = [move_id for move_id in self.ids if move_id]
+        if not move_ids:
+            return
+        pending = self.env.cr.precommit.data.setdefault('team_registration.commission_moves', set())
+        if not pending:
+            self.env.cr.precommit.add(self.env['user.commission.entry'].sudo()._process_pending_moves)
+        pending.update(move_ids)
+
     def write(self, vals):
+        tracked = [fname for fname in COMMISSION_LEDGER_FIELDS if fname in vals]
+        before = {move.id: [move[fname] for fname in tracked] for move in self} if tracked else {}
+
         res = super(AccountMove, self).write(vals)
 
-        for move in self:
-            # 1️⃣ Check if the invoice partner is a coach
-            coach = self.env['res.users'].search([
-                ('partner_id', '=', move.partner_id.id),
-                ('is_coach', '=', True)
-            ], limit=1)
-
-            # 2️⃣ If not a coach, check if partner is a referred player
-            if not coach:
-                coach = self.env['res.users'].search([
-                    ('referred_users.partner_id', '=', move.partner_id.id)
-                ], limit=1)
-
-            # 3️⃣ Trigger _compute_purchases for coach's active tracks
-            if coach:
-                tracks = self.env['user.commission.track'].sudo().search([
-                    ('user_id', '=', coach.id),
-                    ('status', '=', 'active')
-                ])
-                if tracks:
-                    tracks._compute_purchases()
+        # Only record the moves whose commission-relevant values really
+        # changed; the ledger sync queues the affected coaches for the
+        # recompute cron, so nothing is recomputed inside this request.
+        if tracked:
+            self.filtered(
+                lambda move: [move[fname] for fname in tracked] != before.get(move.id)
+            )._commission_mark_dirty()
 
         return res
 
-    @api.model
-    def create(self, vals):
-        invoice = super(AccountMove, self).create(vals)
-
-        if invoice.move_type == 'out_invoice' and invoice.partner_id:
-            user = self.env['res.users'].search([('partner_id', '=', invoice.partner_id.id)], limit=1)
-            
-            if user and user.is_coach:
-                today = fields.Date.today()
-
-                CommissionTrack = self.env['user.commission.track'].sudo()
-
-                # 1. Try to find any active track still valid today
-                existing_track = CommissionTrack.search([
-                    ('user_id', '=', user.id),
-                    ('status', '=', 'active'),
-                    ('start_date', '<=', today),
-                    ('close_date', '>=', today),
-                ], limit=1)
-
-                # 2. If no active, check if there’s already a future active track
-                if not existing_track:
-                    future_track = CommissionTrack.search([
-                        ('user_id', '=', user.id),
-                        ('status', '=', 'active'),
-                        ('start_date', '>', today),
-                    ], limit=1)
-
-                    if future_track:
-                        _logger.info(
-                            "Future active commission track already exists for %s from %s to %s",
-                            user.name, future_track.start_date, future_track.close_date
-                        )
-                        return invoice
-
-                    # 3. If neither active nor future exists, create a new one
-                    last_track = CommissionTrack.search([
-                        ('user_id', '=', user.id)
-                    ], order='close_date desc', limit=1)
-
-                    if last_track:
-                        start_date = last_track.close_date + timedelta(days=1)
-                        seq = last_track.seq + 1
-                    else:
-                        start_date = today
-                        seq = 1
-
-                    # Get commission cycle days from company settings
-                    cycle_days = user.company_id.commission_cycle_days or 90
-                    close_date = start_date + timedelta(days=cycle_days)
-
-                    CommissionTrack.create({
-                        'user_id': user.id,
-                        'seq': seq,
-                        'start_date': start_date,
-                        'close_date': close_date,
-                        'status': 'active',
-                    })
-
-                    _logger.info("New commission track created for coach %s (%s)", user.name, user.id)
-                else:
-                    _logger.info("Existing active commission track still valid for coach %s", user.name)
-            else:
-                _logger.info(
+    @api.model_create_multi
+    def create(self, vals_list):
+        invoices = super(AccountMove, self).create(vals_list)
+        invoices.filtered(
+            lambda move: move.move_type == 'out_invoice' and move.partner_id
+        )._ensure_commission_tracks()
+        return invoices
+
+    def _ensure_commission_tracks(self):
+        """Make sure the direct coach of every invoice has an active track.
+
+        Works on the whole batch: coaches come from the cached commission
+        map, their active and last tracks are read in two grouped queries and
+        the missing tracks are created at once, so importing many invoices
+        does not pay a search per invoice.
+        """
+        if not self:
+            return
+        run = current_run(self.env)
+        coaches = self.env['res.users'].sudo()._get_commission_coaches(self.partner_id.ids)
+        direct_coach = {
+            partner_id: coach_id
+            for partner_id, beneficiaries in coaches.items()
+            for coach_id, kind in beneficiaries
+            if kind == 'direct'
+        }
+        for invoice in self:
+            if invoice.partner_id.id not in direct_coach:
+                run.trace(
                     "Invoice created for non-coach user or no linked user found. Skipping commission logic for partner: %s",
                     invoice.partner_id.name,
                 )
-
-        return invoice
\ No newline at end of file
+        users = self.env['res.users'].browse(sorted({
+            direct_coach[partner_id] for partner_id in self.partner_id.ids if partner_id in direct_coach
+        }))
+        if not users:
+            return
+
+        today = fields.Date.today()
+        CommissionTrack = self.env['user.commission.track'].sudo()
+
+        # Coaches with an active track still valid today, or already
+        # starting in the future, have nothing to do
+        covered = {
+            user.id for [user] in CommissionTrack._read_group([
+                ('user_id', 'in', users.ids),
+                ('status', '=', 'active'),
+                ('close_date', '>=', today),
+            ], ['user_id'])
+        }
+        missing = users.filtered(lambda user: user.id not in covered)
+        for user in users - missing:
+            run.trace("Existing active commission track still valid for coach %s", user.name)
+        if not missing:
+            return
+
+        last_tracks = {
+            user.id: (close_date, seq)
+            for user, close_date, seq in CommissionTrack._read_group(
+                [('user_id', 'in', missing.ids)], ['user_id'], ['close_date:max', 'seq:max'],
+            )
+        }
+        vals_list = []
+        for user in missing:
+            if user.id in last_tracks:
+                last_close_date, last_seq = last_tracks[user.id]
+                start_date = last_close_date + timedelta(days=1)
+                seq = last_seq + 1
+            else:
+                start_date = today
+                seq = 1
+
+            # Get commission cycle days from company settings
+            cycle_days = user.company_id.commission_cycle_days or 90
+            vals_list.append({
+                'user_id': user.id,
+                'seq': seq,
+                'start_date': start_date,
+                'close_date': start_date + timedelta(days=cycle_days),
+                'status': 'active',
+            })
+            run.trace("New commission track created for coach %s (%s)", user.name, user.id)
+
+        CommissionTrack.create(vals_list)
+        run.incr('tracks_created', len(vals_list))
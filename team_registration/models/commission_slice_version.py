@@ -0,0 +1,141 @@
+from odoo import models, fields, api, tools
+from bisect import bisect_right
+from datetime import timedelta
+
+from ..simulator import CommissionSimulation
+
+
+class CommissionSliceVersion(models.Model):
+    _name = 'commission.slice.version'
+    _description = 'Commission Plan Version'
+    _order = 'date_from desc'
+
+    name = fields.Char(string='Name', required=True)
+    date_from = fields.Date(string='Effective From', required=True,
+                            help="Tracks starting on or after this date, and before the next "
+                                 "version, are priced with the slices of this version.")
+    date_to = fields.Date(string='Effective Until', compute='_compute_date_to',
+                          help="Day before the next version starts, empty for the latest one.")
+    slice_ids = fields.One2many('commission.slices', 'version_id', string='Slices', copy=True)
+
+    # One version per date: the versions partition the calendar without gaps
+    _sql_constraints = [
+        ('date_from_uniq', 'unique(date_from)', "Another commission plan version starts on this date."),
+    ]
+
+    @api.depends('date_from')
+    def _compute_date_to(self):
+        dates, _version_ids = self._get_version_table()
+        for version in self:
+            idx = bisect_right(dates, version.date_from) if version.date_from else len(dates)
+            version.date_to = dates[idx] - timedelta(days=1) if idx < len(dates) else False
+
+    def copy_data(self, default=None):
+        """A copy starts the day after the latest version, with the same slices."""
+        default = dict(default or {})
+        vals_list = super().copy_data(default=default)
+        if 'date_from' not in default:
+            latest = self.search([], order='date_from desc', limit=1)
+            next_date = max(latest.date_from + timedelta(days=1), fields.Date.context_today(self))
+            for vals in vals_list:
+                vals['date_from'] = next_date
+                next_date += timedelta(days=1)
+        return vals_list
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        versions = super().create(vals_list)
+        self.env.registry.clear_cache()
+        if not self.env.context.get('commission_skip_reassign'):
+            versions._reassign_open_tracks(min(versions.mapped('date_from')))
+        return versions
+
+    def write(self, vals):
+        old_start = min(self.mapped('date_from')) if 'date_from' in vals else None
+        res = super().write(vals)
+        self.env.registry.clear_cache()
+        if old_start:
+            self._reassign_open_tracks(min(old_start, *self.mapped('date_from')))
+        return res
+
+    def unlink(self):
+        start = min(self.mapped('date_from')) if self else None
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        if start:
+            self._reassign_open_tracks(start)
+        return res
+
+    def _reassign_open_tracks(self, date_from):
+        """Point the open tracks starting on or after ``date_from`` to the
+        version now effective for them and queue their coaches for a
+        recompute. Closed tracks keep the version they were priced with."""
+        tracks = self.env['user.commission.track'].sudo().search([
+            ('status', '!=', 'closed'),
+            ('start_date', '>=', date_from),
+        ])
+        tracks._assign_slice_versions()
+
+    def _queue_open_tracks(self):
+        """Queue for a recompute the coaches whose open tracks are priced
+        with these versions, after a change of their slices."""
+        if not self:
+            return
+        tracks = self.env['user.commission.track'].sudo().search([
+            ('status', '!=', 'closed'),
+            ('slice_version_id', 'in', self.ids),
+        ])
+        self.env['user.commission.queue']._enqueue(tracks.user_id.ids)
+
+    def _get_simulation_table(self):
+        """Slices of this version as a simulator table, in id order like the
+        boundary rule of ``_get_commission_percentage``."""
+        self.ensure_one()
+        return [(s.from_amount, s.to_amount, s.commission_percentage) for s in self.slice_ids.sorted('id')]
+
+    def action_simulate_payout(self):
+        """Price every track with the slices of these versions, without
+        writing anything, and report the payouts against the current one."""
+        simulation = CommissionSimulation.from_tracks(self.env)
+        lines = []
+        for version, result in zip(self, simulation.evaluate_many([v._get_simulation_table() for v in self], top=3)):
+            lines.append("%s: %.2f (%+.2f), %s tracks outside every slice" % (
+                version.name, result['payout'], result['change'], result['unmatched']))
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'type': 'info',
+                'sticky': True,
+                'title': "Payout of %s tracks, currently %.2f" % (len(simulation.purchases), simulation.baseline),
+                'message': "\n".join(lines),
+            },
+        }
+
+    @api.model
+    @tools.ormcache()
+    def _get_version_table(self):
+        """Return ``(dates, version_ids)`` sorted by effective date, to bisect
+        on. Cached per registry and cleared on any create, write or unlink."""
+        self.flush_model(['date_from'])
+        self.env.cr.execute("SELECT date_from, id FROM commission_slice_version ORDER BY date_from")
+        rows = self.env.cr.fetchall()
+        return tuple(date_from for date_from, _id in rows), tuple(version_id for _date, version_id in rows)
+
+    @api.model
+    def _get_version_id_for_date(self, day):
+        """Id of the version effective on ``day``, the oldest one for days
+        before any version, or False when there is no version at all."""
+        dates, version_ids = self._get_version_table()
+        if not version_ids:
+            return False
+        idx = bisect_right(dates, day or fields.Date.today()) - 1
+        return version_ids[max(idx, 0)]
+
+    @api.model
+    def _get_default_version(self):
+        """Version new slices go to by default: the one effective today, or
+        an empty recordset when there is no version at all. Only reads, it
+        serves as a field default; the initial version comes with the
+        module data."""
+        return self.browse(self._get_version_id_for_date(fields.Date.today()))
@@ -1,46 +1,187 @@
-from odoo import models, fields, api
+from odoo import models, fields, api, tools
 from odoo.exceptions import ValidationError
+from bisect import bisect_right
+import psycopg2.errors
+
+OVERLAP_MESSAGE = "Amount range overlaps with another commission slice."
+
 
 class CommissionSlices(models.Model):
     _name = 'commission.slices'
     _description = 'Commission Plan'
 
     name = fields.Char(string='Name')
-    slice_seq = fields.Integer(string='Slice Sequence', readonly=True)
+    slice_seq = fields.Integer(string='Slice Sequence', readonly=True, copy=False)
     from_amount = fields.Float(string='From Amount', required=True, digits=(12, 2))
     to_amount = fields.Float(string='To Amount', required=True, digits=(12, 2))
     commission_percentage = fields.Float(string='Commission %', required=True, digits=(5, 2),
                                          help="Percentage commission for this slice")
+    version_id = fields.Many2one('commission.slice.version', string='Plan Version', required=True,
+                                 ondelete='cascade', index=True,
+                                 default=lambda self: self.env['commission.slice.version']._get_default_version())
 
-    @api.model
-    def create(self, vals):
-        if 'slice_seq' not in vals or not vals['slice_seq']:
-            last = self.search([], order="slice_seq desc", limit=1)
-            vals['slice_seq'] = last.slice_seq + 1 if last else 1
-        return super().create(vals)
+    # Half-open ranges: slices of a version may touch (0-1000, 1000-5000) but
+    # not overlap. An inverted range collapses to an empty one and is left to
+    # _check_overlap. The version is compared as a one-point int4range so
+    # that the index needs no btree_gist extension.
+    _sql_constraints = [
+        ('amount_range_no_overlap',
+         "EXCLUDE USING gist (int4range(version_id, version_id, '[]') WITH &&, "
+         "numrange(from_amount, GREATEST(from_amount, to_amount), '[)') WITH &&)",
+         OVERLAP_MESSAGE),
+    ]
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        next_seq = None
+        for vals in vals_list:
+            if 'slice_seq' not in vals or not vals['slice_seq']:
+                if next_seq is None:
+                    last = self.search([], order="slice_seq desc", limit=1)
+                    next_seq = last.slice_seq + 1 if last else 1
+                vals['slice_seq'] = next_seq
+                next_seq += 1
+        default_version = None
+        for vals in vals_list:
+            if not vals.get('version_id'):
+                default_version = default_version or self.env['commission.slice.version']._get_default_version()
+                if not default_version:
+                    raise ValidationError("Create a commission plan version before its slices.")
+                vals['version_id'] = default_version.id
+        self._check_ranges_available([
+            (vals['version_id'], vals.get('from_amount') or 0.0, vals.get('to_amount') or 0.0)
+            for vals in vals_list
+        ])
+        try:
+            with self.env.cr.savepoint(flush=False):
+                records = super().create(vals_list)
+        except psycopg2.errors.ExclusionViolation:
+            raise ValidationError(OVERLAP_MESSAGE)
+        self.env.registry.clear_cache()
+        records.version_id._queue_open_tracks()
+        return records
+
+    def write(self, vals):
+        if {'from_amount', 'to_amount', 'version_id'} & set(vals):
+            self._check_ranges_available([
+                (vals.get('version_id', rec.version_id.id),
+                 vals.get('from_amount', rec.from_amount), vals.get('to_amount', rec.to_amount))
+                for rec in self
+            ], exclude_ids=self.ids)
+        versions = self.version_id
+        try:
+            with self.env.cr.savepoint():
+                res = super().write(vals)
+                self.flush_recordset()
+        except psycopg2.errors.ExclusionViolation:
+            raise ValidationError(OVERLAP_MESSAGE)
+        self.env.registry.clear_cache()
+        (versions | self.version_id)._queue_open_tracks()
+        return res
 
     def unlink(self):
+        versions = self.version_id
         result = super().unlink()
         self._resequence()
+        self.env.registry.clear_cache()
+        versions.exists()._queue_open_tracks()
         return result
 
     @api.model
     def _resequence(self):
-        all_slices = self.search([], order='slice_seq asc')
-        for idx, rec in enumerate(all_slices, start=1):
-            rec.slice_seq = idx
+        self.flush_model(['slice_seq'])
+        self.env.cr.execute("""
+            UPDATE commission_slices s
+               SET slice_seq = r.seq
+              FROM (
+                    SELECT id, ROW_NUMBER() OVER (ORDER BY slice_seq, id) AS seq
+                      FROM commission_slices
+                   ) r
+             WHERE s.id = r.id
+               AND s.slice_seq IS DISTINCT FROM r.seq
+        """)
+        self.invalidate_model(['slice_seq'])
+
+    @api.model
+    def _check_ranges_available(self, ranges, exclude_ids=()):
+        """Raise a ValidationError before touching the table when one of
+        ``ranges``, ``(version_id, from_amount, to_amount)`` tuples, overlaps
+        another one or an existing slice of the same version.
+
+        One query for the whole batch, served by the gist index of the
+        amount_range_no_overlap constraint, which stays the actual guard
+        against concurrent inserts.
+        """
+        ranges = [(version_id, lo, max(lo, hi)) for version_id, lo, hi in ranges]
+        ordered = sorted(ranges)
+        for (version_id, _lo, hi), (next_version_id, next_lo, _next_hi) in zip(ordered, ordered[1:]):
+            if version_id == next_version_id and next_lo < hi:
+                raise ValidationError(OVERLAP_MESSAGE)
+        if not ranges:
+            return
+        self.flush_model(['from_amount', 'to_amount', 'version_id'])
+        self.env.cr.execute("""
+            SELECT 1
+              FROM commission_slices s,
+                   unnest(%s::int[], %s::numeric[], %s::numeric[]) AS r(version_id, lo, hi)
+             WHERE s.id != ALL(%s)
+               AND s.version_id = r.version_id
+               AND numrange(s.from_amount, GREATEST(s.from_amount, s.to_amount), '[)')
+                   && numrange(r.lo, r.hi, '[)')
+             LIMIT 1
+        """, [[version_id for version_id, _lo, _hi in ranges], [lo for _v, lo, _hi in ranges],
+              [hi for _v, _lo, hi in ranges], list(exclude_ids)])
+        if self.env.cr.fetchone():
+            raise ValidationError(OVERLAP_MESSAGE)
 
     @api.constrains('from_amount', 'to_amount')
     def _check_overlap(self):
+        # Overlaps between slices are rejected by _check_ranges_available and
+        # the amount_range_no_overlap exclusion constraint, only the shape of
+        # each range is checked here.
         for rec in self:
             if rec.from_amount >= rec.to_amount:
                 raise ValidationError("From Amount must be less than To Amount.")
 
-            overlap = self.search([
-                ('id', '!=', rec.id),
-                '|',
-                '&', ('from_amount', '<', rec.to_amount), ('to_amount', '>', rec.from_amount),
-                '&', ('from_amount', '<', rec.to_amount), ('to_amount', '=', False)
-            ])
-            if overlap:
-                raise ValidationError("Amount range overlaps with another commission slice.")
+    @api.model
+    @tools.ormcache('version_id')
+    def _get_slice_table(self, version_id):
+        """Return ``(starts, slices)`` for the slices of ``version_id``: the
+        slices as ``(from_amount, to_amount, commission_percentage, id)``
+        tuples sorted by ``from_amount``, and the matching list of start
+        amounts to bisect on.
+
+        Cached per registry and version, cleared on any create, write or
+        unlink of a slice or a version.
+        """
+        self.flush_model(['from_amount', 'to_amount', 'commission_percentage', 'version_id'])
+        self.env.cr.execute("""
+            SELECT from_amount, to_amount, commission_percentage, id
+              FROM commission_slices
+             WHERE version_id = %s
+          ORDER BY from_amount, id
+        """, [version_id])
+        slices = tuple(
+            (float(from_amount), float(to_amount), float(percentage or 0.0), slice_id)
+            for from_amount, to_amount, percentage, slice_id in self.env.cr.fetchall()
+        )
+        return tuple(from_amount for from_amount, _to, _pct, _id in slices), slices
+
+    @api.model
+    def _get_commission_percentage(self, amount, version_id=None):
+        """Return the ``commission_percentage`` of the slice of ``version_id``
+        containing ``amount`` (bounds included), or 0.0 when no slice
+        matches. Without ``version_id``, the version effective today is used.
+
+        An amount on the boundary shared by two slices belongs to the oldest
+        one, like the ``search(..., limit=1)`` this lookup replaces.
+        """
+        if version_id is None:
+            version_id = self.env['commission.slice.version']._get_version_id_for_date(fields.Date.today())
+        starts, slices = self._get_slice_table(version_id or 0)
+        idx = bisect_right(starts, amount) - 1
+        best = None
+        for from_amount, to_amount, percentage, slice_id in slices[max(idx - 1, 0):idx + 1]:
+            if from_amount <= amount <= to_amount and (best is None or slice_id < best[1]):
+                best = (percentage, slice_id)
+        return best[0] if best else 0.0
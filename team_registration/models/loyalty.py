@@ -0,0 +1,151 @@
+from odoo import models, fields, api, tools
+
+# loyalty.card fields that change which card is a partner's eWallet
+WALLET_CARD_FIELDS = {'partner_id', 'program_id'}
+
+
+class LoyaltyProgram(models.Model):
+    _inherit = 'loyalty.program'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        programs = super().create(vals_list)
+        if any(program.program_type == 'ewallet' for program in programs):
+            self.env.registry.clear_cache()
+        return programs
+
+    def write(self, vals):
+        # Only eWallet programs, before or after the write, change the cache
+        ewallet_changed = {'program_type', 'active', 'sequence'} & set(vals) and (
+            vals.get('program_type') == 'ewallet'
+            or any(program.program_type == 'ewallet' for program in self)
+        )
+        res = super().write(vals)
+        if ewallet_changed:
+            self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        ewallet_unlinked = any(program.program_type == 'ewallet' for program in self)
+        res = super().unlink()
+        if ewallet_unlinked:
+            self.env.registry.clear_cache()
+        return res
+
+    @api.model
+    @tools.ormcache()
+    def _get_ewallet_program_id(self):
+        """Id of the eWallet program coach commissions are paid into, cached
+        per registry and cleared whenever a program changes."""
+        return self.sudo().search([('program_type', '=', 'ewallet')], limit=1).id
+
+    @api.model
+    def _get_ewallet_program(self):
+        return self.sudo().browse(self._get_ewallet_program_id())
+
+
+class LoyaltyCard(models.Model):
+    _inherit = 'loyalty.card'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        cards = super().create(vals_list)
+        if self.env['loyalty.program']._get_ewallet_program() in cards.program_id:
+            self.env.registry.clear_cache()
+        return cards
+
+    def write(self, vals):
+        # Sale loyalty writes and deletes coupon cards on cart updates: only
+        # eWallet cards, before or after the write, change the cache
+        wallet_changed = False
+        if WALLET_CARD_FIELDS & set(vals):
+            program_id = self.env['loyalty.program']._get_ewallet_program_id()
+            wallet_changed = program_id and (
+                vals.get('program_id') == program_id or program_id in self.program_id.ids
+            )
+        res = super().write(vals)
+        if wallet_changed:
+            self.env.registry.clear_cache()
+        return res
+
+    def unlink(self):
+        wallet_unlinked = self.env['loyalty.program']._get_ewallet_program_id() in self.program_id.ids
+        res = super().unlink()
+        if wallet_unlinked:
+            self.env.registry.clear_cache()
+        return res
+
+    @api.model
+    @tools.ormcache()
+    def _get_wallet_card_map(self):
+        """Return ``{partner_id: card_id}`` of the eWallet cards, the oldest
+        card of a partner winning. Cached per registry and cleared when an
+        eWallet card is created or deleted, or changes partner or program.
+        The result is shared: never modify it."""
+        program_id = self.env['loyalty.program']._get_ewallet_program_id()
+        if not program_id:
+            return {}
+        self.flush_model(['partner_id', 'program_id'])
+        self.env.cr.execute("""
+            SELECT DISTINCT ON (partner_id) partner_id, id
+              FROM loyalty_card
+             WHERE program_id = %s
+               AND partner_id IS NOT NULL
+          ORDER BY partner_id, id
+        """, [program_id])
+        return dict(self.env.cr.fetchall())
+
+    @api.model
+    def _get_wallet_cards(self, partner_ids, create=False):
+        """Return ``{partner_id: card}`` with the eWallet card of each of
+        ``partner_ids`` that has one, as superuser.
+
+        With ``create``, the missing cards are created in one batch. Without
+        an eWallet program, nothing is returned.
+        """
+        program = self.env['loyalty.program']._get_ewallet_program()
+        if not program:
+            return {}
+        Card = self.sudo()
+        card_map = self._get_wallet_card_map()
+        partner_ids = list(dict.fromkeys(partner_id for partner_id in partner_ids if partner_id))
+        cards = {
+            partner_id: Card.browse(card_map[partner_id])
+            for partner_id in partner_ids
+            if partner_id in card_map
+        }
+        missing = [partner_id for partner_id in partner_ids if partner_id not in cards]
+        if create and missing:
+            new_cards = Card.create([{
+                'program_id': program.id,
+                'partner_id': partner_id,
+                'points': 0.0,
+            } for partner_id in missing])
+            cards.update(zip(missing, new_cards))
+        return cards
+
+    @api.model
+    def _credit_wallet_points(self, credits, description):
+        """Add ``{card: amount}`` to the points of the cards with one atomic
+        increment, and log one history row per card."""
+        if not credits:
+            return
+        cards = self.sudo().browse([card.id for card in credits])
+        cards.flush_recordset(['points'])
+        self.env.cr.execute("""
+            UPDATE loyalty_card c
+               SET points = COALESCE(c.points, 0) + v.amount,
+                   write_uid = %s,
+                   write_date = NOW() AT TIME ZONE 'UTC'
+              FROM unnest(%s::int[], %s::float8[]) AS v(card_id, amount)
+             WHERE c.id = v.card_id
+        """, [self.env.uid, [card.id for card in credits], list(credits.values())])
+        cards.invalidate_recordset(['points', 'write_uid', 'write_date'])
+        cards.modified(['points'])
+
+        self.env['loyalty.history'].sudo().create([{
+            'card_id': card.id,
+            'description': description,
+            'issued': amount,
+            'used': 0.0,
+        } for card, amount in credits.items()])
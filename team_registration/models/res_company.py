@@ -10,4 +10,19 @@ class ResCompany(models.Model):
     minimum_points_required = fields.Integer(string="Minimum Loyalty Points Required for Discount", help="User must have at least this number of points to apply a loyalty discount.")
     discount_value = fields.Integer(string="Discount", store=True)
     commission_cycle_days = fields.Integer(string="Commission Cycle (days)", default=90)
-    test_today = fields.Date("Test Today", help="Optional date to override today for testing")
\ No newline at end of file
+    test_today = fields.Date("Test Today", help="Optional date to override today for testing")
+    commission_team_depth = fields.Integer(
+        string="Commission Team Depth", default=1,
+        help="Number of referral levels below a coach whose purchases count as the coach's "
+             "team purchases. Changing it resyncs the team entries of the commission ledger.")
+    registration_activity_digest = fields.Boolean(
+        string="Registration Approval Digest",
+        help="Instead of one approval activity per new registration, managers get a single "
+             "digest activity per run of the digest cron.")
+
+    def write(self, vals):
+        res = super().write(vals)
+        if 'commission_team_depth' in vals:
+            self.env.registry.clear_cache()
+            self.env['user.commission.entry'].sudo()._resync_team_entries(self)
+        return res
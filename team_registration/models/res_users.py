@@ -1,5 +1,69 @@
-from odoo import models, fields, api
+from odoo import models, fields, api, tools
 from odoo.exceptions import ValidationError
+from odoo.tools import SQL
+import re
+
+# Logins made of a phone number, as created by the registration approval
+PHONE_LOGIN_RE = re.compile(r'^\+?[\d\s()-]{7,}$')
+
+# Country calling code of the numbers typed in the registration form, whose
+# national trunk prefix "0" is not part of the E.164 number
+PHONE_COUNTRY_CODE = '962'
+
+
+def normalize_phone(phone):
+    """E.164 digits of ``phone``, without the "+" or "00" prefix, or False.
+
+    A national trunk "0" typed after the country code is dropped, so that
+    "+962 079..." and "+962 79..." give the same number. Must stay in line
+    with the SQL backfills of migrations 11.10.29 and 11.10.33.
+    """
+    digits = re.sub(r'\D', '', phone or '')
+    if digits.startswith('00'):
+        digits = digits[2:]
+    if digits.startswith(PHONE_COUNTRY_CODE + '0'):
+        digits = PHONE_COUNTRY_CODE + digits[len(PHONE_COUNTRY_CODE) + 1:]
+    return digits or False
+
+
+def format_national_phone(phone):
+    """International form of a national number typed without the country
+    code, like "0791234567" or "791234567", or False."""
+    phone = (phone or '').strip()
+    if phone.startswith('0'):
+        phone = phone[1:]
+    return '+' + PHONE_COUNTRY_CODE + phone if phone else False
+
+
+# res.users fields that change which coach a partner's purchases belong to
+COMMISSION_MAP_FIELDS = {'is_coach', 'referred_by', 'partner_id', 'active'}
+
+# ORDER BY clauses of the /my/team member list
+TEAM_PAGE_ORDERS = {
+    'total_desc': "COALESCE(totals.total, 0) DESC, members.id",
+    'total_asc': "COALESCE(totals.total, 0), members.id",
+    'name': "p.name, members.id",
+}
+
+# (partner_id, coach_id, kind) of every coach commission beneficiary: the
+# coach on its own purchases, and each coach up the referral path of an active
+# user, at most commission_team_depth levels above it, on the user's purchases.
+COMMISSION_BENEFICIARIES_QUERY = """
+    SELECT u.partner_id, u.id AS user_id, 'direct' AS kind
+      FROM res_users u
+     WHERE u.is_coach
+ UNION ALL
+    SELECT ref.partner_id, coach.id AS user_id, 'team' AS kind
+      FROM res_users ref
+     CROSS JOIN LATERAL unnest(string_to_array(rtrim(ref.referral_path, '/'), '/')::int[])
+           WITH ORDINALITY AS path(ancestor_id, position)
+      JOIN res_users coach ON coach.id = path.ancestor_id AND coach.is_coach
+      JOIN res_company company ON company.id = coach.company_id
+     WHERE ref.active
+       AND coach.id != ref.id
+       AND array_length(string_to_array(rtrim(ref.referral_path, '/'), '/'), 1) - path.position
+           <= COALESCE(company.commission_team_depth, 1)
+"""
 
 class ResUsers(models.Model):
     _inherit = 'res.users'
@@ -11,18 +75,281 @@ class ResUsers(models.Model):
 
     referred_by = fields.Many2one('res.users', string="Referred By")
     referred_users = fields.One2many('res.users', 'referred_by', string="Referred Users")
-    referral_link = fields.Char(string="Referral Link", readonly=True, store=True)
+    referral_path = fields.Char(
+        string="Referral Path", readonly=True, copy=False,
+        help="Ids of the referral chain from the top referrer down to this user, "
+             "like '1/5/9/'. Maintained from Referred By.")
+    phone_normalized = fields.Char(
+        string="Normalized Phone", compute='_compute_phone_normalized', store=True, copy=False,
+        help="E.164 digits of the login when the login is a phone number.")
+    referral_link = fields.Char(string="Referral Link", readonly=True, store=True, compute='_compute_referral_link')
 
+    commission_track_ids = fields.One2many('user.commission.track', 'user_id', string="Commission Tracks")
+    commission_closed_total = fields.Float(
+        string="Closed Commission", compute='_compute_commission_balance', store=True)
+    commission_transferred_total = fields.Float(
+        string="Transferred Commission", compute='_compute_commission_balance', store=True)
+    commission_balance = fields.Float(
+        string="Commission Balance", compute='_compute_commission_balance', store=True,
+        help="Commission of the closed tracks not transferred to the wallet yet.")
+    commission_active_track_id = fields.Many2one(
+        'user.commission.track', string="Active Commission Track",
+        compute='_compute_commission_active_track', store=True)
 
+    _sql_constraints = [
+        ('phone_normalized_uniq', 'unique(phone_normalized)', "A user with this phone number already exists."),
+    ]
 
-    @api.model
-    def create(self, vals):
-        user = super().create(vals)
-   
+    @api.model_create_multi
+    def create(self, vals_list):
+        users = super().create(vals_list)
+        users._init_referral_paths()
+        if any(vals.get('is_coach') or vals.get('referred_by') for vals in vals_list):
+            self.env.registry.clear_cache()
+        return users
+
+    @api.depends('login')
+    def _compute_phone_normalized(self):
+        for user in self:
+            is_phone = user.login and PHONE_LOGIN_RE.match(user.login)
+            user.phone_normalized = normalize_phone(user.login) if is_phone else False
+
+    @api.depends()
+    def _compute_referral_link(self):
         base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
-        referral_link = f"{base_url}/web/signup?mobile_field=true&ref={user.id}"
-        user.write({'referral_link': referral_link})  # this saves it
-        return user
+        for user in self:
+            user.referral_link = f"{base_url}/web/signup?mobile_field=true&ref={user.id}"
+
+    def write(self, vals):
+        res = super().write(vals)
+        if 'referred_by' in vals:
+            self._update_referral_path()
+        if COMMISSION_MAP_FIELDS & set(vals):
+            self.env.registry.clear_cache()
+        if 'referred_by' in vals:
+            # The moved users and their downline now earn team commission
+            # for other coaches: move their ledger entries along
+            self.env['user.commission.entry'].sudo()._resync_partner_entries(
+                self._get_referral_subtree().partner_id.ids)
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
+
+    def init(self):
+        super().init()
+        tools.create_index(self._cr, 'res_users_referral_path_index',
+                           self._table, ['referral_path text_pattern_ops'])
+
+    @api.constrains('referred_by')
+    def _check_referral_cycle(self):
+        if self._has_cycle('referred_by'):
+            raise ValidationError("A user cannot be referred by one of their own downline.")
+
+    def _update_referral_path(self):
+        """Set the referral path of the users from their referrer's one and
+        move their whole downline along, one UPDATE per user."""
+        self.flush_model(['referred_by', 'referral_path'])
+        cr = self.env.cr
+        for user in self:
+            cr.execute("""
+                SELECT u.referral_path, COALESCE(p.referral_path, '') || u.id || '/'
+                  FROM res_users u
+             LEFT JOIN res_users p ON p.id = u.referred_by
+                 WHERE u.id = %s
+            """, [user.id])
+            old_path, new_path = cr.fetchone()
+            if old_path == new_path:
+                continue
+            if old_path:
+                cr.execute("""
+                    UPDATE res_users
+                       SET referral_path = %s || substr(referral_path, %s)
+                     WHERE referral_path LIKE %s
+                """, [new_path, len(old_path) + 1, old_path + '%'])
+            else:
+                cr.execute("UPDATE res_users SET referral_path = %s WHERE id = %s", [new_path, user.id])
+        self.invalidate_model(['referral_path'])
+
+    def _get_referral_subtree(self):
+        """Return these users and every user below them in the referral
+        tree, with one query on the referral path index."""
+        paths = [user.referral_path for user in self if user.referral_path]
+        if not paths:
+            return self
+        self.flush_model(['referral_path'])
+        self.env.cr.execute(
+            "SELECT id FROM res_users WHERE referral_path LIKE ANY(%s)",
+            [[path + '%' for path in paths]],
+        )
+        return self | self.browse(row[0] for row in self.env.cr.fetchall())
+
+    def _init_referral_paths(self):
+        """Set the referral path of freshly created users in one statement.
+
+        New users have no downline yet, so unlike ``_update_referral_path``
+        nothing has to move; referrers created in the same batch are
+        resolved by the recursive part.
+        """
+        if not self:
+            return
+        self.flush_model(['referred_by', 'referral_path'])
+        self.env.cr.execute("""
+            WITH RECURSIVE tree AS (
+                SELECT u.id, COALESCE(p.referral_path, '') || u.id || '/' AS path
+                  FROM res_users u
+             LEFT JOIN res_users p ON p.id = u.referred_by
+                 WHERE u.id = ANY(%(ids)s)
+                   AND (u.referred_by IS NULL OR NOT u.referred_by = ANY(%(ids)s))
+             UNION ALL
+                SELECT u.id, tree.path || u.id || '/'
+                  FROM res_users u
+                  JOIN tree ON u.referred_by = tree.id
+                 WHERE u.id = ANY(%(ids)s)
+            )
+            UPDATE res_users u
+               SET referral_path = tree.path
+              FROM tree
+             WHERE u.id = tree.id
+        """, {'ids': self.ids})
+        self.invalidate_recordset(['referral_path'])
+
+    @api.model
+    def _rebuild_referral_paths(self):
+        """Recompute every referral path from ``referred_by`` in one statement."""
+        self.flush_model(['referred_by', 'referral_path'])
+        self.env.cr.execute("""
+            WITH RECURSIVE tree AS (
+                SELECT id, id || '/' AS path
+                  FROM res_users
+                 WHERE referred_by IS NULL
+             UNION ALL
+                SELECT u.id, tree.path || u.id || '/'
+                  FROM res_users u
+                  JOIN tree ON u.referred_by = tree.id
+            )
+            UPDATE res_users u
+               SET referral_path = tree.path
+              FROM tree
+             WHERE u.id = tree.id
+               AND u.referral_path IS DISTINCT FROM tree.path
+        """)
+        self.invalidate_model(['referral_path'])
+
+    def _read_team_purchase_page(self, order='total_desc', limit=20, offset=0):
+        """Return ``(count, [(member_id, total), ...])`` for one page of the
+        active users referred by the coach ``self``.
+
+        ``total`` is the untaxed amount of a member's paid customer invoices
+        dated within any closed track of the coach, and ``order`` is one of
+        ``TEAM_PAGE_ORDERS``. Everything comes from one grouped query, so the
+        cost does not depend on the number of tracks or members.
+        """
+        self.ensure_one()
+        self.env['account.move'].flush_model(
+            ['move_type', 'state', 'payment_state', 'partner_id', 'invoice_date', 'amount_untaxed'])
+        self.env['user.commission.track'].flush_model(['user_id', 'status', 'start_date', 'close_date'])
+        self.flush_model(['referred_by', 'partner_id', 'active'])
+        self.env['res.partner'].flush_model(['name'])
+        self.env.cr.execute(SQL("""
+            WITH members AS (
+                SELECT u.id, u.partner_id
+                  FROM res_users u
+                 WHERE u.referred_by = %(coach_id)s
+                   AND u.active
+            ), totals AS (
+                SELECT m.partner_id, SUM(m.amount_untaxed) AS total
+                  FROM account_move m
+                 WHERE m.partner_id IN (SELECT partner_id FROM members)
+                   AND m.move_type = 'out_invoice'
+                   AND m.state = 'posted'
+                   AND m.payment_state IN ('paid', 'in_payment')
+                   AND EXISTS (
+                        SELECT 1
+                          FROM user_commission_track t
+                         WHERE t.user_id = %(coach_id)s
+                           AND t.status = 'closed'
+                           AND m.invoice_date BETWEEN t.start_date AND t.close_date
+                       )
+              GROUP BY m.partner_id
+            )
+            SELECT members.id, COALESCE(totals.total, 0), COUNT(*) OVER ()
+              FROM members
+              JOIN res_partner p ON p.id = members.partner_id
+         LEFT JOIN totals ON totals.partner_id = members.partner_id
+          ORDER BY %(order)s
+             LIMIT %(limit)s
+            OFFSET %(offset)s
+        """, coach_id=self.id, order=SQL(TEAM_PAGE_ORDERS.get(order, TEAM_PAGE_ORDERS['total_desc'])),
+            limit=limit, offset=offset))
+        rows = self.env.cr.fetchall()
+        if not rows:
+            # The page may be past the end, count the members on their own
+            return self.search_count([('referred_by', '=', self.id)]), []
+        return rows[0][2], [(member_id, float(total)) for member_id, total, _count in rows]
+
+    @api.depends('commission_track_ids.status', 'commission_track_ids.commission',
+                 'commission_track_ids.commission_transferred')
+    def _compute_commission_balance(self):
+        """Running balance per coach, recomputed only for the coaches whose
+        tracks close or get transferred, with one grouped query per batch."""
+        user_ids = [user_id for user_id in self.ids if user_id]
+        totals = {
+            user.id: (commission, transferred)
+            for user, commission, transferred in self.env['user.commission.track'].sudo()._read_group(
+                [('user_id', 'in', user_ids), ('status', '=', 'closed')],
+                ['user_id'],
+                ['commission:sum', 'commission_transferred:sum'],
+            )
+        } if user_ids else {}
+        for user in self:
+            commission, transferred = totals.get(user.id, (0.0, 0.0))
+            user.commission_closed_total = commission
+            user.commission_transferred_total = transferred
+            user.commission_balance = max(commission - transferred, 0.0)
+
+    @api.depends('commission_track_ids.status', 'commission_track_ids.seq')
+    def _compute_commission_active_track(self):
+        """Active track of the coach, whose stored figures and snapshot stamp
+        the portal home commission card shows. Only changes on a rollover."""
+        for user in self:
+            active = user.commission_track_ids.filtered(lambda t: t.status == 'active')
+            user.commission_active_track_id = active.sorted('seq')[:1]
+
+    @api.model
+    @tools.ormcache()
+    def _get_commission_partner_map(self):
+        """Return ``{partner_id: ((coach_id, kind), ...)}`` for every partner
+        whose paid invoices earn a coach commission.
+
+        ``kind`` is ``'direct'`` when the partner is the coach itself and
+        ``'team'`` when the partner belongs to a user of the coach's downline,
+        up to the company's ``commission_team_depth`` levels. The map is cached
+        per registry and cleared whenever ``is_coach``, ``referred_by``,
+        ``partner_id`` or ``active`` change on a user, or the team depth of a
+        company changes, so invoice hooks resolve coaches without querying. The
+        result is shared: never modify it.
+        """
+        self.flush_model(['partner_id', 'is_coach', 'referral_path', 'active', 'company_id'])
+        self.env['res.company'].flush_model(['commission_team_depth'])
+        self.env.cr.execute(COMMISSION_BENEFICIARIES_QUERY)
+        partner_map = {}
+        for partner_id, coach_id, kind in self.env.cr.fetchall():
+            partner_map[partner_id] = partner_map.get(partner_id, ()) + ((coach_id, kind),)
+        return partner_map
+
+    @api.model
+    def _get_commission_coaches(self, partner_ids):
+        """Batch lookup on the cached map: ``{partner_id: ((coach_id, kind), ...)}``
+        restricted to ``partner_ids`` that have at least one coach."""
+        partner_map = self._get_commission_partner_map()
+        return {
+            partner_id: partner_map[partner_id]
+            for partner_id in partner_ids
+            if partner_id in partner_map
+        }
 
 
     @api.constrains('is_coach', 'is_nutritionist', 'is_owner')
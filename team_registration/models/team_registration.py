@@ -1,4 +1,14 @@
 from odoo import models, fields, api
+from odoo.exceptions import ValidationError
+import logging
+
+from .res_users import normalize_phone
+
+_logger = logging.getLogger(__name__)
+
+# Largest certificate accepted, in bytes
+CERT_MAX_SIZE = 10 * 1024 * 1024
+
 
 class TeamRegistration(models.Model):
     _name = 'team.registration'
@@ -7,6 +17,8 @@ class TeamRegistration(models.Model):
 
     name = fields.Char(string='Full Name', required=True)
     phone = fields.Char(required=True)
+    phone_normalized = fields.Char(
+        string="Normalized Phone", compute='_compute_phone_normalized', store=True, copy=False)
     email = fields.Char()
     password = fields.Char(required=True)
     role = fields.Selection([
@@ -24,71 +36,206 @@ class TeamRegistration(models.Model):
         ('master', 'Master'),
         ('phd', 'PhD'),
     ])
-    cert_file = fields.Binary(string='Certificate of Practice')
+    cert_file = fields.Binary(string='Certificate of Practice', attachment=True)
     cert_filename = fields.Char()
     state = fields.Selection([
         ('draft', 'Draft'),
+        ('approving', 'Approval Queued'),
+        ('error', 'Approval Failed'),
         ('approved', 'Approved'),
         ('cancelled', 'Cancelled'),
     ], default='draft')
     referred_by = fields.Many2one('res.users', string="Referred By")
-    invitation_link = fields.Char(string='Invitation Link', readonly=True)
     user_id = fields.Many2one('res.users', string="Created User", readonly=True)
-
-    def action_approve(self):
+    invitation_link = fields.Char(string='Invitation Link', related='user_id.referral_link')
+    approval_error = fields.Text(
+        string="Approval Error", readonly=True, copy=False,
+        help="Why the background approval of this registration failed.")
+    approval_notified = fields.Boolean(
+        string="Managers Notified", readonly=True, copy=False, index=True,
+        help="Set once the approval managers got an activity for this registration.")
+
+    _sql_constraints = [
+        ('phone_normalized_uniq', 'unique(phone_normalized)', "A registration with this phone number already exists."),
+    ]
+
+    @api.depends('phone')
+    def _compute_phone_normalized(self):
         for rec in self:
-            password = rec.password if isinstance(rec.password, str) and rec.password.strip() else "123"
-            normalized_phone = rec.phone.lstrip("+")
+            rec.phone_normalized = normalize_phone(rec.phone)
 
-            portal_group = self.env.ref('base.group_portal')
+    # Above this many registrations, approval runs in the background cron
+    _approval_sync_limit = 200
 
+    def action_approve(self):
+        """Approve the draft registrations, and the ones whose background
+        approval failed, right away for a small selection and through the
+        approval cron for a large one."""
+        registrations = self.filtered(lambda rec: rec.state in ('draft', 'error'))
+        if len(registrations) <= self._approval_sync_limit:
+            registrations._approve_registrations()
+            return True
+
+        registrations.write({'state': 'approving'})
+        cron = self.env.ref('team_registration.ir_cron_team_registration_approval', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'type': 'info',
+                'message': "%s registrations were queued for approval, they are approved in the background." % len(registrations),
+                'next': {'type': 'ir.actions.act_window_close'},
+            },
+        }
+
+    def _prepare_user_values(self, portal_group):
+        self.ensure_one()
+        password = self.password if isinstance(self.password, str) and self.password.strip() else "123"
+        return {
+            'name': self.name,
+            'login': self.phone,
+            'email': self.email,
+            'mobile': self.phone_normalized,
+            'password': password,
             # Create user with only portal group
-            user = self.env['res.users'].sudo().create({
-                'name': rec.name,
-                'login': rec.phone,
-                'email': rec.email,
-                'mobile': normalized_phone,
-                'password': password,
-                'groups_id': [(6, 0, [portal_group.id])],
-                'referred_by': rec.referred_by.id,
-            })
-
+            'groups_id': [(6, 0, [portal_group.id])],
+            'referred_by': self.referred_by.id,
+            'is_coach': self.role == 'coach',
+            'is_nutritionist': self.role == 'nutritionist',
+            'is_owner': self.role == 'owner',
+        }
+
+    def _approve_registrations(self):
+        """Create the users of these registrations in one batch; their
+        referral links are computed on creation. The links to the users are
+        assigned in the cache and flushed with the approval write."""
+        if not self:
+            return
+        portal_group = self.env.ref('base.group_portal')
+        users = self.env['res.users'].sudo().create([
+            rec._prepare_user_values(portal_group) for rec in self
+        ])
+        for rec, user in zip(self, users):
             rec.user_id = user
+        self.write({'state': 'approved', 'approval_error': False})
 
-            # Assign flags
-            user.is_coach = rec.role == 'coach'
-            user.is_nutritionist = rec.role == 'nutritionist'
-            user.is_owner = rec.role == 'owner'
-
-            # Generate invitation link
-            base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
-            rec.invitation_link = f"{base_url}/web/signup?mobile_field=true&ref={user.id}"
-            user.referral_link = f"{base_url}/web/signup?mobile_field=true&ref={user.id}"
-            rec.state = 'approved'
+    @api.model
+    def _cron_approve_registrations(self, batch_size=200):
+        """Approve one batch of queued registrations and report the progress
+        to the cron, which calls again while registrations remain."""
+        batch = self.search([('state', '=', 'approving')], order='id', limit=batch_size)
+        try:
+            with self.env.cr.savepoint():
+                batch._approve_registrations()
+        except Exception:
+            # One bad registration (a login or phone already taken) must not
+            # block the queue: retry one by one and set the failures aside
+            _logger.warning("Registration approval batch failed, retrying its %s registrations one by one",
+                            len(batch))
+            for rec in batch:
+                try:
+                    with self.env.cr.savepoint():
+                        rec._approve_registrations()
+                except Exception as e:
+                    _logger.exception("Approval of registration %s failed", rec.id)
+                    rec.write({'state': 'error', 'approval_error': str(e)})
+        remaining = self.search_count([('state', '=', 'approving')])
+        _logger.info("Registration approval: %s processed, %s remaining", len(batch), remaining)
+        if self.env.context.get('ir_cron_progress_id'):
+            self.env['ir.cron']._notify_progress(done=len(batch), remaining=remaining)
+        elif remaining:
+            cron = self.env.ref('team_registration.ir_cron_team_registration_approval', raise_if_not_found=False)
+            if cron:
+                cron.sudo()._trigger()
 
     def action_cancel(self):
         for rec in self:
             rec.state = 'cancelled'
 
     @api.model
-    def create(self, vals):
-        record = super().create(vals)
-
+    def _check_cert_size(self, vals):
+        """Reject base64 ``cert_file`` values decoding to more than
+        ``CERT_MAX_SIZE`` bytes, without decoding them."""
+        data = vals.get('cert_file')
+        if data and len(data) * 3 // 4 > CERT_MAX_SIZE:
+            raise ValidationError("The certificate cannot be larger than %s MB." % (CERT_MAX_SIZE // (1024 * 1024)))
+
+    def _attach_certificate(self, filename, raw):
+        """Store the raw bytes of an uploaded certificate in the filestore,
+        skipping the base64 round trip of a ``cert_file`` write. Identical
+        files share one filestore blob through the attachment checksum."""
+        self.ensure_one()
+        if len(raw) > CERT_MAX_SIZE:
+            raise ValidationError("The certificate cannot be larger than %s MB." % (CERT_MAX_SIZE // (1024 * 1024)))
+        self.env['ir.attachment'].sudo().create({
+            'name': 'cert_file',
+            'res_model': self._name,
+            'res_field': 'cert_file',
+            'res_id': self.id,
+            'type': 'binary',
+            'raw': raw,
+        })
+        self.cert_filename = filename
+        self.invalidate_recordset(['cert_file'])
+
+    def write(self, vals):
+        self._check_cert_size(vals)
+        return super().write(vals)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        for vals in vals_list:
+            self._check_cert_size(vals)
+        records = super().create(vals_list)
+        # In digest mode the managers are notified by the digest cron
+        if not self.env.company.registration_activity_digest:
+            records._notify_approval_managers()
+        return records
+
+    def _get_approval_managers(self):
         team_registration_group = self.env.ref('team_registration.group_team_registration_manager')
-        users = self.env['res.users'].sudo().search([('groups_id', 'in', team_registration_group.id)])
+        return self.env['res.users'].sudo().search([('groups_id', 'in', team_registration_group.id)])
+
+    def _notify_approval_managers(self):
+        """Create the approval activities of every manager for all these
+        registrations in one batch."""
+        if not self:
+            return
+        managers = self._get_approval_managers()
         model_id = self.env['ir.model']._get_id('team.registration')
+        activity_type_id = self.env.ref('mail.mail_activity_data_todo').id
+        self.env['mail.activity'].sudo().create([{
+            'res_model_id': model_id,
+            'res_id': record.id,
+            'activity_type_id': activity_type_id,
+            'summary': 'Team Registration Approval Needed',
+            'note': 'A new registration is awaiting your approval.',
+            'user_id': user.id,
+        } for record in self for user in managers])
+        self.sudo().write({'approval_notified': True})
 
-        for user in users:
-            self.env['mail.activity'].sudo().create({
-                'res_model_id': model_id,
-                'res_id': record.id,
-                'activity_type_id': self.env.ref('mail.mail_activity_data_todo').id,
-                'summary': 'Team Registration Approval Needed',
-                'note': 'A new registration is awaiting your approval.',
-                'user_id': user.id,
-            })
-
-        return record
+    @api.model
+    def _cron_approval_digest(self):
+        """Give every manager one activity listing the draft registrations
+        received since the previous run, on the oldest one of them."""
+        pending = self.search([('state', '=', 'draft'), ('approval_notified', '=', False)], order='id')
+        if not pending:
+            return
+        managers = self._get_approval_managers()
+        names = pending.mapped('name')
+        note = "%s new registrations are awaiting your approval: %s" % (
+            len(pending), ", ".join(names[:20]) + (", ..." if len(names) > 20 else ""))
+        self.env['mail.activity'].sudo().create([{
+            'res_model_id': self.env['ir.model']._get_id('team.registration'),
+            'res_id': pending[0].id,
+            'activity_type_id': self.env.ref('mail.mail_activity_data_todo').id,
+            'summary': '%s Team Registrations Approval Needed' % len(pending),
+            'note': note,
+            'user_id': user.id,
+        } for user in managers])
+        pending.write({'approval_notified': True})
 
 
 
@@ -0,0 +1,266 @@
+from odoo import models, fields, api
+from odoo.tools import split_every
+import logging
+
+from ..metrics import commission_run, current_run, instrumented
+from .res_users import COMMISSION_BENEFICIARIES_QUERY
+
+_logger = logging.getLogger(__name__)
+
+PAID_STATES = ('paid', 'in_payment')
+
+
+class UserCommissionEntry(models.Model):
+    _name = "user.commission.entry"
+    _description = "User Commission Ledger Entry"
+    _order = "date desc, id desc"
+
+    user_id = fields.Many2one("res.users", string="Coach", required=True, index=True, ondelete="cascade")
+    track_id = fields.Many2one("user.commission.track", string="Commission Track", index=True, ondelete="set null")
+    move_id = fields.Many2one("account.move", string="Invoice", required=True, index=True, ondelete="cascade")
+    partner_id = fields.Many2one("res.partner", string="Customer")
+    kind = fields.Selection([
+        ("direct", "Direct"),
+        ("team", "Team"),
+    ], string="Kind", required=True)
+    date = fields.Date("Invoice Date", required=True, index=True)
+    amount = fields.Float("Amount")
+    is_reversal = fields.Boolean("Reversal", readonly=True)
+    is_reversed = fields.Boolean("Reversed", readonly=True)
+    reversal_of_id = fields.Many2one("user.commission.entry", string="Reversal Of", readonly=True, ondelete="cascade")
+
+    currency_id = fields.Many2one(
+        "res.currency",
+        default=lambda self: self.env.company.currency_id,
+    )
+
+    @api.model
+    def _get_move_beneficiaries(self, moves):
+        """Return ``{partner_id: ((coach_id, kind), ...)}`` for the partners of
+        ``moves``.
+
+        A coach earns a direct entry on their own invoices, and a team entry on
+        the invoices of the users of their downline.
+        """
+        return self.env['res.users'].sudo()._get_commission_coaches(moves.partner_id.ids)
+
+    @api.model
+    def _sync_moves(self, moves):
+        """Bring the ledger in line with the current state of ``moves``.
+
+        Paid customer invoices get one entry per beneficiary coach. When an
+        invoice stops being paid, or its partner, date or amount changes, the
+        live entries that no longer match are reversed and, if needed,
+        replaced; the matching ones are left alone. Calling it twice is
+        harmless.
+        """
+        moves = moves.sudo().exists()
+        if not moves:
+            return self.browse()
+        run = current_run(self.env)
+        run.incr('invoices_scanned', len(moves))
+
+        beneficiaries = self._get_move_beneficiaries(moves)
+        live_entries = self.sudo().search([
+            ('move_id', 'in', moves.ids),
+            ('is_reversal', '=', False),
+            ('is_reversed', '=', False),
+        ])
+        live_by_move = {}
+        for entry in live_entries:
+            live_by_move.setdefault(entry.move_id.id, self.browse())
+            live_by_move[entry.move_id.id] |= entry
+
+        to_reverse = self.browse()
+        to_create = []
+        for move in moves:
+            desired = set()
+            if (move.move_type == 'out_invoice' and move.state == 'posted'
+                    and move.payment_state in PAID_STATES and move.invoice_date):
+                for coach_id, kind in beneficiaries.get(move.partner_id.id, []):
+                    desired.add((coach_id, kind, move.partner_id.id, move.invoice_date,
+                                 round(move.amount_untaxed, 2)))
+
+            live = live_by_move.get(move.id, self.browse())
+            current = {}
+            for entry in live:
+                key = (entry.user_id.id, entry.kind, entry.partner_id.id, entry.date, round(entry.amount, 2))
+                if key in current or key not in desired:
+                    to_reverse |= entry
+                else:
+                    current[key] = entry
+            to_create += [{
+                'user_id': coach_id,
+                'move_id': move.id,
+                'partner_id': partner_id,
+                'kind': kind,
+                'date': date,
+                'amount': amount,
+            } for coach_id, kind, partner_id, date, amount in desired - current.keys()]
+
+        if to_reverse:
+            reversals = self.sudo().create([{
+                'user_id': entry.user_id.id,
+                'track_id': entry.track_id.id,
+                'move_id': entry.move_id.id,
+                'partner_id': entry.partner_id.id,
+                'kind': entry.kind,
+                'date': entry.date,
+                'amount': -entry.amount,
+                'is_reversal': True,
+                'reversal_of_id': entry.id,
+            } for entry in to_reverse])
+            to_reverse.write({'is_reversed': True})
+            run.incr('entries_reversed', len(reversals))
+
+        entries = self.sudo().create(to_create) if to_create else self.browse()
+        run.incr('entries_created', len(entries))
+        entries._assign_tracks()
+        self.env['user.commission.queue']._enqueue((to_reverse | entries).user_id.ids)
+        return entries
+
+    def _assign_tracks(self):
+        """Link entries without a track to the track of their coach whose
+        start_date → close_date window contains the entry date."""
+        entries = self.filtered(lambda e: not e.track_id)
+        if not entries:
+            return
+        tracks = self.env['user.commission.track'].sudo().search([
+            ('user_id', 'in', entries.user_id.ids),
+            ('start_date', '<=', max(entries.mapped('date'))),
+            ('close_date', '>=', min(entries.mapped('date'))),
+        ], order='seq, id')
+        tracks_by_user = {}
+        for track in tracks:
+            tracks_by_user.setdefault(track.user_id.id, []).append(track)
+        for entry in entries:
+            entry.track_id = next((
+                track for track in tracks_by_user.get(entry.user_id.id, [])
+                if track.start_date <= entry.date <= track.close_date
+            ), False)
+
+    @api.model
+    def _process_pending_moves(self):
+        """Precommit hook: sync the ledger for the moves flagged during the
+        transaction (see ``AccountMove._commission_mark_dirty``)."""
+        move_ids = self.env.cr.precommit.data.pop('team_registration.commission_moves', set())
+        if move_ids:
+            with commission_run(self.env, 'commission_ledger_sync', logging.DEBUG):
+                self._sync_moves(self.env['account.move'].browse(move_ids))
+                self.env.flush_all()
+
+    @api.model
+    @instrumented('resync_team_commission_entries')
+    def _resync_team_entries(self, companies):
+        """Bring the team entries in line with the referral depth of
+        ``companies``, after it changed.
+
+        Only the invoices that have, or should now have, a team entry for a
+        coach of these companies are synced, through ``_sync_moves``: dropped
+        beneficiaries get a reversal, new ones a fresh entry, and the rest of
+        the ledger is left untouched.
+        """
+        self.env.flush_all()
+        self.env.cr.execute("""
+            SELECT m.id
+              FROM account_move m
+              JOIN ({beneficiaries}) b ON b.partner_id = m.partner_id AND b.kind = 'team'
+              JOIN res_users coach ON coach.id = b.user_id
+             WHERE coach.company_id IN %(company_ids)s
+               AND m.move_type = 'out_invoice'
+               AND m.state = 'posted'
+               AND m.payment_state IN %(paid_states)s
+               AND m.invoice_date IS NOT NULL
+             UNION
+            SELECT e.move_id
+              FROM user_commission_entry e
+              JOIN res_users coach ON coach.id = e.user_id
+             WHERE coach.company_id IN %(company_ids)s
+               AND e.kind = 'team'
+               AND NOT COALESCE(e.is_reversal, FALSE)
+               AND NOT COALESCE(e.is_reversed, FALSE)
+        """.format(beneficiaries=COMMISSION_BENEFICIARIES_QUERY), {
+            'company_ids': tuple(companies.ids),
+            'paid_states': PAID_STATES,
+        })
+        self._sync_move_ids([move_id for move_id, in self.env.cr.fetchall()])
+
+    @api.model
+    @instrumented('resync_partner_commission_entries')
+    def _resync_partner_entries(self, partner_ids):
+        """Bring the entries of the invoices of ``partner_ids`` in line with
+        the referral tree, after these partners' users moved in it.
+
+        Their paid invoices, and the ones that still have a live team entry,
+        are synced through ``_sync_moves``: the coaches they left get a
+        reversal and the coaches they joined a fresh entry.
+        """
+        if not partner_ids:
+            return
+        self.env.flush_all()
+        self.env.cr.execute("""
+            SELECT m.id
+              FROM account_move m
+             WHERE m.partner_id IN %(partner_ids)s
+               AND m.move_type = 'out_invoice'
+               AND m.state = 'posted'
+               AND m.payment_state IN %(paid_states)s
+               AND m.invoice_date IS NOT NULL
+             UNION
+            SELECT e.move_id
+              FROM user_commission_entry e
+             WHERE e.partner_id IN %(partner_ids)s
+               AND e.kind = 'team'
+               AND NOT COALESCE(e.is_reversal, FALSE)
+               AND NOT COALESCE(e.is_reversed, FALSE)
+        """, {
+            'partner_ids': tuple(partner_ids),
+            'paid_states': PAID_STATES,
+        })
+        self._sync_move_ids([move_id for move_id, in self.env.cr.fetchall()])
+
+    @api.model
+    def _sync_move_ids(self, move_ids):
+        """``_sync_moves`` over ``move_ids``, a thousand moves at a time."""
+        for batch_ids in split_every(1000, move_ids):
+            self._sync_moves(self.env['account.move'].browse(batch_ids))
+            self.env.flush_all()
+
+    @api.model
+    @instrumented('rebuild_commission_ledger')
+    def _rebuild_commission_ledger(self):
+        """Rebuild the ledger from the paid invoice history.
+
+        Used when installing or upgrading the module; afterwards the ledger is
+        maintained incrementally from the invoice hooks.
+        """
+        self.env.flush_all()
+        cr = self.env.cr
+        cr.execute("DELETE FROM user_commission_entry")
+        cr.execute("""
+            INSERT INTO user_commission_entry
+                   (user_id, move_id, partner_id, kind, date, amount, currency_id,
+                    is_reversal, is_reversed, create_uid, create_date, write_uid, write_date)
+            SELECT b.user_id, m.id, m.partner_id, b.kind, m.invoice_date, m.amount_untaxed, %(currency_id)s,
+                   FALSE, FALSE, %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+              FROM account_move m
+              JOIN ({beneficiaries}) b ON b.partner_id = m.partner_id
+             WHERE m.move_type = 'out_invoice'
+               AND m.state = 'posted'
+               AND m.payment_state IN %(paid_states)s
+               AND m.invoice_date IS NOT NULL
+        """.format(beneficiaries=COMMISSION_BENEFICIARIES_QUERY), {
+            'currency_id': self.env.company.currency_id.id,
+            'uid': self.env.uid,
+            'paid_states': PAID_STATES,
+        })
+        current_run(self.env).incr('entries_created', cr.rowcount)
+        cr.execute("""
+            UPDATE user_commission_entry e
+               SET track_id = t.id
+              FROM user_commission_track t
+             WHERE t.user_id = e.user_id
+               AND e.date BETWEEN t.start_date AND t.close_date
+        """)
+        self.env.invalidate_all()
+        self.env['user.commission.track'].search([('status', '!=', 'closed')])._compute_purchases()
@@ -0,0 +1,84 @@
+from odoo import models, fields, api
+import logging
+import threading
+
+from ..metrics import current_run, instrumented
+
+_logger = logging.getLogger(__name__)
+
+
+class UserCommissionQueue(models.Model):
+    _name = "user.commission.queue"
+    _description = "Coaches Waiting for a Commission Recompute"
+    _order = "id"
+
+    user_id = fields.Many2one("res.users", string="Coach", required=True, ondelete="cascade")
+
+    _sql_constraints = [
+        ('user_uniq', 'unique(user_id)', "A coach can only be queued once."),
+    ]
+
+    @api.model
+    def _enqueue(self, user_ids):
+        """Mark coaches as dirty and wake up the recompute cron.
+
+        A coach that is already queued is left as is, so a burst of invoice
+        updates still results in one recompute per coach.
+        """
+        user_ids = sorted({user_id for user_id in user_ids if user_id})
+        if not user_ids:
+            return
+        self.env.cr.execute("""
+            INSERT INTO user_commission_queue (user_id, create_uid, create_date, write_uid, write_date)
+            SELECT user_id, %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+              FROM unnest(%(user_ids)s::int[]) AS user_id
+                ON CONFLICT (user_id) DO NOTHING
+        """, {'uid': self.env.uid, 'user_ids': user_ids})
+        if self.env.cr.rowcount:
+            cron = self.env.ref('team_registration.ir_cron_commission_queue', raise_if_not_found=False)
+            if cron:
+                cron.sudo()._trigger()
+
+    @api.model
+    @instrumented('process_commission_queue')
+    def _process_queue(self, chunk_size=200):
+        """Recompute the active tracks of every queued coach exactly once.
+
+        Coaches are taken in chunks with ``SKIP LOCKED`` so that parallel
+        workers never pick the same coach, and each chunk is committed on its
+        own when running as a cron. A chunk is claimed by deleting its rows
+        before the recompute: a coach queued again meanwhile gets a new row,
+        picked up by the next chunk, instead of being merged into a row
+        that is about to go.
+        """
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        Track = self.env['user.commission.track'].sudo()
+        run = current_run(self.env)
+        processed = 0
+        while True:
+            self.env.cr.execute("""
+                DELETE FROM user_commission_queue
+                 WHERE id IN (
+                        SELECT id
+                          FROM user_commission_queue
+                      ORDER BY id
+                         LIMIT %s
+                           FOR UPDATE SKIP LOCKED
+                       )
+             RETURNING user_id
+            """, [chunk_size])
+            user_ids = [user_id for user_id, in self.env.cr.fetchall()]
+            if not user_ids:
+                break
+
+            tracks = Track.search([
+                ('user_id', 'in', user_ids),
+                ('status', '=', 'active'),
+            ])
+            with run.timer('recompute_purchases'):
+                tracks._recompute_purchases()
+            processed += len(user_ids)
+            run.incr('coaches', len(user_ids))
+            if auto_commit:
+                self.env.cr.commit()
+        return processed
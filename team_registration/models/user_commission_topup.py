@@ -0,0 +1,102 @@
+from odoo import models, fields, api
+from odoo.exceptions import UserError
+from odoo.tools import float_compare
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class UserCommissionTopup(models.Model):
+    _name = "user.commission.topup"
+    _description = "Commission Wallet Top-up"
+    _order = "id desc"
+
+    user_id = fields.Many2one("res.users", string="Coach", required=True, index=True, ondelete="cascade")
+    idempotency_key = fields.Char("Idempotency Key", required=True, readonly=True)
+    amount = fields.Float("Amount", readonly=True)
+    card_id = fields.Many2one("loyalty.card", string="Wallet Card", readonly=True, ondelete="set null")
+    new_balance = fields.Float("Commission Balance After", readonly=True)
+    wallet_balance = fields.Float("Wallet Balance After", readonly=True)
+
+    _sql_constraints = [
+        ('user_key_uniq', 'unique(user_id, idempotency_key)',
+         "A top-up request can only be processed once."),
+    ]
+
+    @api.model
+    def _topup(self, user, amount, idempotency_key):
+        """Move ``amount`` of the closed commission of the coach ``user`` to
+        their eWallet and return ``{'amount', 'new_balance', 'wallet_balance',
+        'replayed'}``.
+
+        A request is processed once per ``idempotency_key``, which the client
+        must send: sending it again, after a double click or a network retry,
+        returns the first result. A request without a key is refused, minting
+        one here would pay a retried request twice.
+        Concurrent top-ups of a coach are serialized on the locks of their
+        closed tracks, the wallet is credited with an atomic increment and
+        the amount is spread over the closed tracks in one statement. Raise
+        a ``UserError`` when the top-up is not possible, nothing is kept then.
+        """
+        if not idempotency_key:
+            raise UserError("A top-up request needs an idempotency key.")
+        key = idempotency_key
+        with self.env.cr.savepoint():
+            self.env.cr.execute("""
+                INSERT INTO user_commission_topup
+                       (user_id, idempotency_key, amount, create_uid, create_date, write_uid, write_date)
+                VALUES (%(user_id)s, %(key)s, %(amount)s, %(uid)s, NOW() AT TIME ZONE 'UTC',
+                        %(uid)s, NOW() AT TIME ZONE 'UTC')
+                    ON CONFLICT (user_id, idempotency_key) DO NOTHING
+             RETURNING id
+            """, {'user_id': user.id, 'key': key, 'amount': amount, 'uid': self.env.uid})
+            row = self.env.cr.fetchone()
+            if not row:
+                return self._replay_topup(user, amount, key)
+            topup = self.sudo().browse(row[0])
+
+            Track = self.env['user.commission.track'].sudo()
+            balances = Track._lock_closed_tracks([user.id])
+            if user.id not in balances:
+                raise UserError("No closed commissions available.")
+            available_balance = balances[user.id]
+            if float_compare(available_balance, 0.0, precision_digits=2) <= 0:
+                raise UserError("No current balance available.")
+            if float_compare(amount, available_balance, precision_digits=2) > 0:
+                raise UserError(f"Amount exceeds current balance ({available_balance}).")
+
+            tracks = Track._spread_commission_transfer({user.id: amount})
+            Card = self.env['loyalty.card'].sudo()
+            card = Card._get_wallet_cards([user.partner_id.id], create=True).get(user.partner_id.id)
+            if not card:
+                raise UserError("eWallet program not found.")
+            Card._credit_wallet_points({card: amount}, "Top-up from Commission Balance")
+            tracks.refresh_current_balance()
+
+            topup.write({
+                'card_id': card.id,
+                'new_balance': user.sudo().commission_balance,
+                'wallet_balance': card.points,
+            })
+        _logger.info(
+            "Transferred %s from commission to wallet for user_id=%s | new_balance=%s | wallet_points=%s",
+            amount, user.id, topup.new_balance, topup.wallet_balance,
+        )
+        return topup._get_topup_result()
+
+    @api.model
+    def _replay_topup(self, user, amount, key):
+        topup = self.sudo().search([('user_id', '=', user.id), ('idempotency_key', '=', key)])
+        if float_compare(topup.amount, amount, precision_digits=2):
+            raise UserError("This top-up request was already sent with another amount.")
+        _logger.info("Replayed top-up %s for user_id=%s", key, user.id)
+        return dict(topup._get_topup_result(), replayed=True)
+
+    def _get_topup_result(self):
+        self.ensure_one()
+        return {
+            'amount': self.amount,
+            'new_balance': self.new_balance,
+            'wallet_balance': self.wallet_balance,
+            'replayed': False,
+        }
@@ -1,7 +1,11 @@
-from odoo import models, fields, api
+from odoo import models, fields, api, tools
 from odoo.exceptions import ValidationError
 from datetime import timedelta
 import logging
+import threading
+import time
+
+from ..metrics import current_run, instrumented
 
 _logger = logging.getLogger(__name__)
 
@@ -21,19 +25,49 @@ class UserCommissionTrack(models.Model):
         ("closed", "Closed"),
     ], string="Status", default="inactive")
 
-    direct_purchase = fields.Float("Direct Purchase", compute="_compute_purchases", store=True)
-    indirect_purchase = fields.Float("Team Purchase", compute="_compute_purchases", store=True)
-    total_purchase = fields.Float("Total Purchase", compute="_compute_purchases", store=True)
-    commission = fields.Float("Earned Commission", compute="_compute_purchases", store=True)
-    commission_rate = fields.Float("Commission Rate (%)", compute="_compute_purchases", store=True)
-    current_balance = fields.Float("Current Balance", compute="_compute_purchases", store=True)
+    # Written by _compute_purchases while the track is open, frozen once closed
+    direct_purchase = fields.Float("Direct Purchase", readonly=True)
+    indirect_purchase = fields.Float("Team Purchase", readonly=True)
+    total_purchase = fields.Float("Total Purchase", readonly=True)
+    commission = fields.Float("Earned Commission", readonly=True)
+    commission_rate = fields.Float("Commission Rate (%)", readonly=True)
+    current_balance = fields.Float("Current Balance", related="user_id.commission_balance")
     commission_transferred = fields.Float("Transferred to Wallet", default=0.0)
+    entry_ids = fields.One2many("user.commission.entry", "track_id", string="Commission Entries")
+    slice_version_id = fields.Many2one(
+        "commission.slice.version", string="Plan Version", readonly=True,
+        help="Commission plan version effective when the track started, its slices price the track.")
+    snapshot_version = fields.Integer(
+        "Snapshot Version", compute="_compute_snapshot_stamp", store=True,
+        help="Bumped from a sequence whenever a figure of the track shown on the coach's "
+             "commission card changes, used for HTTP caching.")
+    snapshot_date = fields.Datetime("Snapshot Date", compute="_compute_snapshot_stamp", store=True)
 
     currency_id = fields.Many2one(
         "res.currency",
         default=lambda self: self.env.company.currency_id,
     )
 
+    def init(self):
+        super().init()
+        # Serves the per-coach lookups, with or without a status filter, in seq order
+        tools.create_index(self._cr, 'user_commission_track_user_status_seq_index',
+                           self._table, ['user_id', 'status', 'seq'])
+        self._cr.execute("CREATE SEQUENCE IF NOT EXISTS user_commission_track_snapshot_seq")
+
+    @api.depends('status', 'seq', 'direct_purchase', 'indirect_purchase', 'total_purchase',
+                 'commission', 'commission_rate', 'commission_transferred')
+    def _compute_snapshot_stamp(self):
+        """Stamp the tracks whose card figures changed, with one sequence
+        value per batch. Kept on the track so that recomputes and rollovers
+        do not write to the coach."""
+        self.env.cr.execute("SELECT nextval('user_commission_track_snapshot_seq')")
+        version = self.env.cr.fetchone()[0]
+        now = fields.Datetime.now()
+        for track in self:
+            track.snapshot_version = version
+            track.snapshot_date = now
+
     @api.constrains('user_id')
     def _check_user_is_coach(self):
         """Ensure only coaches can have commission tracks"""
@@ -41,110 +75,80 @@ class UserCommissionTrack(models.Model):
             if track.user_id and not track.user_id.is_coach:
                 raise ValidationError("Commission tracking is only available for coaches. User '%s' is not a coach." % track.user_id.name)
 
-    @api.model
-    def create(self, vals):
+    @api.model_create_multi
+    def create(self, vals_list):
         """Override create to validate coach status"""
-        if 'user_id' in vals:
-            user = self.env['res.users'].browse(vals['user_id'])
+        users = self.env['res.users'].browse({vals['user_id'] for vals in vals_list if vals.get('user_id')})
+        for user in users:
             if not user.is_coach:
                 raise ValidationError("Commission tracking can only be created for coaches. User '%s' is not a coach." % user.name)
-        return super().create(vals)
+        tracks = super().create(vals_list)
+        tracks.filtered(lambda track: not track.slice_version_id)._assign_slice_versions(recompute=False)
+        tracks._link_commission_entries()
+        # A track created closed is frozen with the ledger as it is now
+        closed = tracks.filtered(lambda track: track.status == 'closed')
+        closed._update_purchase_values()
+        (tracks - closed)._compute_purchases()
+        return tracks
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {'user_id', 'start_date', 'close_date'} & set(vals):
+            self.env['user.commission.entry'].sudo().search([('track_id', 'in', self.ids)]).track_id = False
+            self._link_commission_entries()
+        if 'start_date' in vals and 'slice_version_id' not in vals:
+            self.filtered(lambda track: track.status != 'closed')._assign_slice_versions(recompute=False)
+        if {'user_id', 'start_date', 'close_date', 'status'} & set(vals):
+            self._compute_purchases()
+        return res
+
+    def _link_commission_entries(self):
+        """Attach the ledger entries of the coaches that are not linked to a
+        track yet and fall inside the window of one of these tracks."""
+        orphans = self.env['user.commission.entry'].sudo().search([
+            ('user_id', 'in', self.user_id.ids),
+            ('track_id', '=', False),
+        ])
+        orphans._assign_tracks()
+        if orphans.track_id:
+            self.env['user.commission.queue']._enqueue(orphans.track_id.user_id.ids)
 
-    @api.depends('user_id', 'user_id.partner_id', 'user_id.referred_users',
-                'start_date', 'close_date', 'status', 'commission_transferred')
     def _compute_purchases(self):
         """Compute all purchases and commissions for the current cycle,
-        isolated to that track's start_date → close_date window.
+        isolated to that track's start_date → close_date window, and close
+        the expired active tracks.
+
+        Closed tracks are skipped: closing freezes their figures, so later
+        referral changes or transfers do not rewrite past commissions. Use
+        ``action_reopen_and_recompute`` to correct them.
+
+        New ledger entries do not trigger this compute by themselves: their
+        coaches are queued in ``user.commission.queue`` and recomputed by cron.
         """
         # today = fields.Date.today()
         # today = fields.Date.from_string('2032-06-22') 
         today = self.env.company.test_today or fields.Date.today()
 
-        for track in self:
-            user = track.user_id
-
-            # default values if no transactions
-            direct_purchase = 0.0
-            indirect_purchase = 0.0
-            total_purchase = 0.0
-            commission = 0.0
-            rate = 0.0
-
-            if user and track.start_date and track.close_date:
-                # --- Direct purchases in this period ---
-                direct_invoices = self.env['account.move'].sudo().search([
-                    ('move_type', '=', 'out_invoice'),
-                    ('state', '=', 'posted'),
-                    ('payment_state', 'in', ['paid', 'in_payment']),
-                    ('partner_id', '=', user.partner_id.id),
-                    ('invoice_date', '>=', track.start_date),
-                    ('invoice_date', '<=', track.close_date),
-                ])
-                direct_purchase = sum(inv.amount_untaxed for inv in direct_invoices)
-
-
-                # --- Indirect (team) purchases ---
-                for ref_user in user.referred_users:
-                    _logger.info("Processing referred user: %s (ID: %s, Partner ID: %s)", 
-                                ref_user.name, ref_user.id, ref_user.partner_id.id)
-
-                    invoices = self.env['account.move'].sudo().search([
-                        ('move_type', '=', 'out_invoice'),
-                        ('state', '=', 'posted'),
-                        ('payment_state', 'in', ['paid', 'in_payment']),
-                        ('partner_id', '=', ref_user.partner_id.id),
-                        ('invoice_date', '>=', track.start_date),
-                        ('invoice_date', '<=', track.close_date),
-                    ])
+        tracks = self.filtered(lambda track: track.status != 'closed')
+        tracks._update_purchase_values()
 
-                    _logger.info("Found %s invoices for referred user %s", len(invoices), ref_user.name)
-
-                    for inv in invoices:
-                        _logger.info("Invoice %s | Date: %s | Untaxed: %s | Paid: %s", 
-                                    inv.name, inv.invoice_date, inv.amount_untaxed, inv.payment_state)
-
-                    indirect_purchase += sum(inv.amount_untaxed for inv in invoices)
-
-                _logger.info("Total indirect purchase so far: %s", indirect_purchase)
-
-                total_purchase = direct_purchase + indirect_purchase
-                _logger.info("Final total purchase (Direct + Indirect): %s + %s = %s",
-                            direct_purchase, indirect_purchase, total_purchase)
-
-
-                # --- Commission slice ---
-                commission_slice = self.env['commission.slices'].sudo().search([
-                    ('from_amount', '<=', total_purchase),
-                    ('to_amount', '>=', total_purchase),
-                ], limit=1)
-
-                rate = (commission_slice.commission_percentage or 0.0) if commission_slice else 0.0
-                _logger.info(
-                    "User: %s | Commission Percentage from slice: %s | Calculated rate: %s",
-                    user.name,
-                    commission_slice.commission_percentage if commission_slice else 0.0,
-                    rate
-                )
-                commission = total_purchase * rate
-
-            # --- Set computed values ---
-            track.direct_purchase = direct_purchase
-            track.indirect_purchase = indirect_purchase
-            track.total_purchase = total_purchase
-            track.commission = commission
-            track.commission_rate = rate * 100
+        run = current_run(self.env)
+        expired = self.browse()
+        next_cycles = []
+        for track in tracks:
+            user = track.user_id
 
             # --- Auto-close active cycles when needed ---
             if track.status == "active" and track.close_date and track.close_date < today:
-                track.status = "closed"
-                _logger.info("Closing cycle for %s (seq %s)", user.name, track.seq)
+                expired |= track
+                run.trace("closing cycle of %s (seq %s)", user.name, track.seq)
                 cycle_days = track.user_id.company_id.commission_cycle_days or 90
 
-                # Create next cycle
+                # Next cycle, created with the others below
                 last_seq = track.seq
                 next_start = track.close_date + timedelta(days=1)
                 next_close = next_start + timedelta(days=cycle_days)
-                self.create({
+                next_cycles.append({
                     "user_id": user.id,
                     "seq": last_seq + 1,
                     "start_date": next_start,
@@ -152,160 +156,333 @@ class UserCommissionTrack(models.Model):
                     "status": "active",
                 })
 
-            # --- Current balance = sum of closed commissions minus transferred amount ---
-            if track.user_id:
-                closed_tracks = self.search([
-                    ('user_id', '=', track.user_id.id),
-                    ('status', '=', 'closed')
-                ])
-                total_commission = sum(closed_tracks.mapped('commission'))
-                total_transferred = sum(closed_tracks.mapped('commission_transferred'))
-
-                track.current_balance = max(total_commission - total_transferred, 0.0)
-    
+        if expired:
+            expired.write({"status": "closed"})
+            run.incr('tracks_closed', len(expired))
+            self.create(next_cycles)
+
+    def _assign_slice_versions(self, recompute=True):
+        """Point these tracks to the plan version effective on their start
+        date, from the cached version table. With ``recompute``, the coaches
+        of the tracks that changed version are queued for a recompute."""
+        Version = self.env['commission.slice.version']
+        by_version = {}
+        for track in self:
+            version_id = Version._get_version_id_for_date(track.start_date)
+            if version_id != track.slice_version_id.id:
+                by_version.setdefault(version_id, self.browse())
+                by_version[version_id] |= track
+        for version_id, tracks in by_version.items():
+            tracks.write({'slice_version_id': version_id})
+            if recompute:
+                self.env['user.commission.queue']._enqueue(tracks.user_id.ids)
+
+    def _update_purchase_values(self):
+        """Write the purchase figures of these tracks from the ledger,
+        whatever their status.
+
+        Works on the whole recordset at once: purchase totals are summed from
+        the commission ledger in one grouped query and rates come from the
+        cached slice table of each track's plan version, so the number of
+        queries does not grow with the number of tracks. ``current_balance``
+        is the coach's running
+        ``commission_balance``.
+        """
+        run = current_run(self.env)
+        run.incr('tracks_computed', len(self))
+        with run.timer('read_purchase_totals'):
+            totals = self._read_purchase_totals()
+        CommissionSlices = self.env['commission.slices'].sudo()
+        Version = self.env['commission.slice.version'].sudo()
+
+        for track in self:
+            # default values if no transactions
+            direct_purchase = 0.0
+            indirect_purchase = 0.0
+            total_purchase = 0.0
+            commission = 0.0
+            rate = 0.0
+
+            if track.user_id and track.start_date and track.close_date:
+                direct_purchase, indirect_purchase = totals.get(track, (0.0, 0.0))
+                total_purchase = direct_purchase + indirect_purchase
+
+                # --- Commission slice ---
+                rate = CommissionSlices._get_commission_percentage(
+                    total_purchase,
+                    track.slice_version_id.id or Version._get_version_id_for_date(track.start_date),
+                )
+                commission = total_purchase * rate
+
+            values = {
+                'direct_purchase': direct_purchase,
+                'indirect_purchase': indirect_purchase,
+                'total_purchase': total_purchase,
+                'commission': commission,
+                'commission_rate': rate * 100,
+            }
+            # Leave unchanged tracks alone, no write, no dependent recompute
+            if any(track[fname] != value for fname, value in values.items()):
+                track.write(values)
+
+    def _recompute_purchases(self):
+        """Recompute the purchase figures of the open tracks of this
+        recordset, in one batch, and store the result."""
+        self._compute_purchases()
+        self.flush_recordset()
+
+    def action_reopen_and_recompute(self):
+        """Admin correction: recompute the frozen figures of these closed
+        tracks from the current ledger, in one batch. They stay closed, the
+        coach balances follow the new commissions."""
+        closed = self.filtered(lambda track: track.status == 'closed')
+        closed._update_purchase_values()
+        _logger.info("Recomputed %s closed commission tracks of %s coaches", len(closed), len(closed.user_id))
+        return True
+
+    def _read_purchase_totals(self):
+        """Return ``{track: (direct_purchase, indirect_purchase)}`` for the
+        tracks of this recordset, summed from their ``user.commission.entry``
+        ledger rows (reversals included, so reversed invoices net out).
+        """
+        track_ids = [track_id for track_id in self.ids if track_id]
+        if not track_ids:
+            return {}
+        totals = {}
+        groups = self.env['user.commission.entry'].sudo()._read_group(
+            [('track_id', 'in', track_ids)],
+            ['track_id', 'kind'],
+            ['amount:sum'],
+        )
+        for track, kind, amount in groups:
+            direct, team = totals.get(track, (0.0, 0.0))
+            if kind == 'direct':
+                direct += amount
+            else:
+                team += amount
+            totals[track] = (direct, team)
+        return totals
+
     def refresh_current_balance(self):
         """Manually refresh current balance for a user"""
-        for track in self:
-            if track.user_id:
-                closed_tracks = self.search([
-                    ('user_id', '=', track.user_id.id),
-                    ('status', '=', 'closed')
-                ])
-                total_commission = sum(closed_tracks.mapped('commission'))
-                total_transferred = sum(closed_tracks.mapped('commission_transferred'))
-                track.current_balance = max(total_commission - total_transferred, 0.0)
+        users = self.user_id
+        for fname in ('commission_closed_total', 'commission_transferred_total', 'commission_balance'):
+            self.env.add_to_compute(users._fields[fname], users)
+        users.flush_recordset(['commission_closed_total', 'commission_transferred_total', 'commission_balance'])
 
     @api.model
-    def cron_process_commission_tracks(self):
+    @instrumented('cron_process_commission_tracks')
+    def cron_process_commission_tracks(self, chunk_size=500, partition=0, partitions=1, time_budget=300):
         """Daily cron: close expired active tracks and create next cycles.
 
         Reuses the existing _compute_purchases auto-close logic by invoking it on
         active tracks whose close_date has passed.
+
+        The backlog is processed in chunks of ``chunk_size`` tracks, each one
+        committed on its own. When ``time_budget`` seconds are spent and tracks
+        remain, the cron re-triggers itself instead of running on. Several
+        cron records can share the work by calling it with the same
+        ``partitions`` and a different ``partition``: each one only handles
+        the coaches whose ``user_id % partitions == partition``.
         """
         today = self.env.company.test_today or fields.Date.today()
-        expired_active = self.search([
-            ('status', '=', 'active'),
-            ('close_date', '<', today),
-        ])
-        if not expired_active:
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        run = current_run(self.env)
+        started = time.time()
+        processed = chunks = 0
+
+        while True:
+            chunk = self._get_expired_active_chunk(today, chunk_size, partition, partitions)
+            if not chunk:
+                break
+            chunk_start = time.time()
+            # Trigger compute to execute the auto-close + next-cycle creation logic
+            chunk._recompute_purchases()
+            self.env.flush_all()
+            if auto_commit:
+                self.env.cr.commit()
+            processed += len(chunk)
+            chunks += 1
+            run.incr('chunks')
+            _logger.info(
+                "Commission cron [%s/%s]: chunk %s closed %s tracks in %.2fs",
+                partition, partitions, chunks, len(chunk), time.time() - chunk_start,
+            )
+            if time.time() - started > time_budget:
+                if self._get_expired_active_chunk(today, 1, partition, partitions):
+                    cron = self.env['ir.cron'].browse(self.env.context.get('cron_id')).exists() \
+                        or self.env.ref('team_registration.ir_cron_commission_tracks_rollover', raise_if_not_found=False)
+                    if cron:
+                        cron._trigger()
+                    _logger.info(
+                        "Commission cron [%s/%s]: time budget spent, backlog left for the next run",
+                        partition, partitions,
+                    )
+                break
+
+        if not processed:
             _logger.info("Commission cron: no expired active tracks found.")
-            return
 
-        # Trigger compute to execute the auto-close + next-cycle creation logic
-        _logger.info("Commission cron: processing %s expired active tracks", len(expired_active))
-        expired_active._compute_purchases()
-        _logger.info("Commission cron: processing completed.")
+    @api.model
+    def _get_expired_active_chunk(self, today, limit, partition=0, partitions=1):
+        """Oldest expired active tracks of the given coach partition."""
+        self.flush_model(['status', 'close_date', 'user_id'])
+        self.env.cr.execute("""
+            SELECT id
+              FROM user_commission_track
+             WHERE status = 'active'
+               AND close_date < %s
+               AND user_id %% %s = %s
+          ORDER BY close_date, id
+             LIMIT %s
+        """, [today, max(partitions, 1), partition, limit])
+        return self.browse([track_id for track_id, in self.env.cr.fetchall()])
 
     @api.model
-    def cron_auto_commission_topup(self):
+    @instrumented('cron_auto_commission_topup')
+    def cron_auto_commission_topup(self, chunk_size=200):
         """Automatic commission top-up cron job.
         
         This method automatically transfers available commission balance to eWallet
         for all coaches who have closed commission tracks with available balance.
+
+        Balances come from one grouped query, then coaches are credited in
+        chunks: cards, history and transferred amounts are handled in batch.
+        A chunk that fails is retried coach by coach, so one bad coach is
+        logged and skipped instead of aborting the whole run.
         """
-        _logger.info("Starting automatic commission top-up cron job")
-        
-        try:
-            # Find all coaches with closed commission tracks
-            coaches = self.env['res.users'].sudo().search([('is_coach', '=', True)])
-            processed_count = 0
-            total_amount = 0.0
-            
-            for coach in coaches:
-                # Find all closed commission tracks for this coach
-                closed_tracks = self.search([
-                    ('user_id', '=', coach.id),
-                    ('status', '=', 'closed')
-                ])
-                
-                if not closed_tracks:
-                    continue
-                
-                # Calculate available commission balance
-                total_commission = sum(closed_tracks.mapped('commission'))
-                total_transferred = sum(closed_tracks.mapped('commission_transferred'))
-                available_balance = total_commission - total_transferred
-                
-                if available_balance <= 0:
-                    continue
-                
-                _logger.info("Processing auto top-up for coach %s (ID: %s) with balance: %s", 
-                           coach.name, coach.id, available_balance)
-                
-                # Find "eWallet" loyalty program
-                program = self.env['loyalty.program'].sudo().search([('program_type', '=', 'ewallet')], limit=1)
-                if not program:
-                    _logger.error("No eWallet program found for auto top-up")
-                    continue
-                
-                # Find or create loyalty card for eWallet
-                card = self.env['loyalty.card'].sudo().search([
-                    ('partner_id', '=', coach.partner_id.id),
-                    ('program_id', '=', program.id)
-                ], limit=1)
-                
-                if not card:
-                    card = self.env['loyalty.card'].sudo().create({
-                        'program_id': program.id,
-                        'partner_id': coach.partner_id.id,
-                        'points': 0.0,
-                    })
-                    _logger.info("Created new eWallet card for coach %s, card_id=%s", coach.name, card.id)
-                
-                # Add points to eWallet
-                card.sudo().write({'points': card.points + available_balance})
-                self.env['loyalty.history'].sudo().create({
-                    'card_id': card.id,
-                    'description': "Automatic Top-up from Commission Balance (Cron)",
-                    'issued': available_balance,
-                    'used': 0.0,
-                })
-                
-                # Update transferred commission on all closed tracks
-                for track in closed_tracks:
-                    remaining_to_transfer = track.commission - track.commission_transferred
-                    if remaining_to_transfer > 0:
-                        track.sudo().write({
-                            'commission_transferred': track.commission
-                        })
-                
-                # Force recomputation of current_balance for all tracks
-                closed_tracks.refresh_current_balance()
-                
-                processed_count += 1
-                total_amount += available_balance
-                
-                _logger.info(
-                    "Auto top-up completed for coach %s: transferred %s to wallet (total wallet points: %s)",
-                    coach.name, available_balance, card.points
-                )
-            
-            _logger.info(
-                "Automatic commission top-up cron completed: processed %s coaches, total amount: %s",
-                processed_count, total_amount
-            )
-            
-        except Exception as e:
-            _logger.error("Error in automatic commission top-up cron: %s", str(e))
+        if not self.env['loyalty.program']._get_ewallet_program():
+            _logger.error("No eWallet program found for auto top-up")
+            return
 
-    def refresh_current_balance(self):
-        """Manually refresh current balance for a user"""
-        _logger.info("=== DEBUG refresh_current_balance START ===")
-        for track in self:
-            _logger.info("Processing track ID: %s, User: %s", track.id, track.user_id.name)
+        run = current_run(self.env)
+        balances = self._read_available_balances()
+        coach_ids = sorted(balances)
+
+        for start in range(0, len(coach_ids), chunk_size):
+            chunk = {coach_id: balances[coach_id] for coach_id in coach_ids[start:start + chunk_size]}
+            try:
+                with self.env.cr.savepoint():
+                    self._credit_commission_wallets(chunk, "Automatic Top-up from Commission Balance (Cron)")
+                credited = chunk
+            except Exception:
+                _logger.warning("Auto top-up chunk failed, retrying its %s coaches one by one", len(chunk))
+                credited = {}
+                for coach_id, amount in chunk.items():
+                    try:
+                        with self.env.cr.savepoint():
+                            self._credit_commission_wallets(
+                                {coach_id: amount}, "Automatic Top-up from Commission Balance (Cron)")
+                        credited[coach_id] = amount
+                    except Exception:
+                        run.incr('coaches_failed')
+                        _logger.exception("Auto top-up failed for coach ID %s (balance %s)", coach_id, amount)
+
+            run.incr('coaches_credited', len(credited))
+            run.incr('amount', sum(credited.values()))
 
-            if track.user_id:
-                closed_tracks = self.search([
-                    ('user_id', '=', track.user_id.id),
-                    ('status', '=', 'closed')
-                ])
-                _logger.info("Found %s closed tracks for user %s", len(closed_tracks), track.user_id.name)
+    @api.model
+    def _read_available_balances(self):
+        """Return ``{coach_id: commission - transferred}`` over closed tracks,
+        for the coaches with a positive balance, in one grouped query."""
+        self.flush_model(['user_id', 'status', 'commission', 'commission_transferred'])
+        self.env['res.users'].flush_model(['is_coach'])
+        self.env.cr.execute("""
+            SELECT t.user_id, SUM(t.commission) - SUM(t.commission_transferred)
+              FROM user_commission_track t
+              JOIN res_users u ON u.id = t.user_id AND u.is_coach
+             WHERE t.status = 'closed'
+          GROUP BY t.user_id
+            HAVING SUM(t.commission) - SUM(t.commission_transferred) > 0
+        """)
+        return dict(self.env.cr.fetchall())
 
-                total_commission = sum(closed_tracks.mapped('commission'))
-                total_transferred = sum(closed_tracks.mapped('commission_transferred'))
-                _logger.info("Total commission: %s, Total transferred: %s", total_commission, total_transferred)
+    @api.model
+    def _credit_commission_wallets(self, amounts, description):
+        """Credit the closed commissions of the coaches ``amounts`` (``{coach_id:
+        amount}``) to their eWallet cards and mark them as transferred.
+
+        The amounts are only a hint: the balances are read again under the
+        track locks, so a manual top-up made in between is not paid twice.
+        Missing cards are created in one batch, points are added with one
+        atomic increment, history rows are created with one ``create`` and
+        the closed tracks are updated with one set-based UPDATE.
+        """
+        if not amounts:
+            return
+        amounts = {
+            coach_id: amount
+            for coach_id, amount in self._lock_closed_tracks(list(amounts)).items()
+            if amount > 0
+        }
+        if not amounts:
+            return
+        tracks = self._spread_commission_transfer(amounts)
 
-                track.current_balance = max(total_commission - total_transferred, 0.0)
-                _logger.info("Setting current_balance to: %s", track.current_balance)
+        coaches = self.env['res.users'].sudo().browse(list(amounts))
+        Card = self.env['loyalty.card'].sudo()
+        card_by_partner = Card._get_wallet_cards(coaches.partner_id.ids, create=True)
+        Card._credit_wallet_points(
+            {card_by_partner[coach.partner_id.id]: amounts[coach.id] for coach in coaches}, description)
 
-        _logger.info("=== DEBUG refresh_current_balance END ===")
\ No newline at end of file
+        # Only the coach balance depends on the transfer; closed tracks keep
+        # their computed figures.
+        tracks.refresh_current_balance()
+
+    @api.model
+    def _lock_closed_tracks(self, user_ids):
+        """Lock the closed tracks of the coaches ``user_ids`` and return
+        ``{coach_id: commission - transferred}`` as seen under the lock, for
+        the coaches having closed tracks.
+
+        Rows are always locked in id order, before any wallet card, so that
+        top-ups and the auto top-up cron cannot deadlock each other.
+        """
+        if not user_ids:
+            return {}
+        self.flush_model(['user_id', 'status', 'commission', 'commission_transferred'])
+        self.env.cr.execute("""
+            SELECT user_id, commission - commission_transferred
+              FROM user_commission_track
+             WHERE user_id IN %s
+               AND status = 'closed'
+          ORDER BY id
+               FOR UPDATE
+        """, [tuple(user_ids)])
+        balances = {}
+        for user_id, remaining in self.env.cr.fetchall():
+            balances[user_id] = balances.get(user_id, 0.0) + (remaining or 0.0)
+        return balances
+
+    @api.model
+    def _spread_commission_transfer(self, amounts):
+        """Add ``{coach_id: amount}`` to the transferred commission of the
+        coaches' closed tracks, filling the oldest ones first, in one
+        statement. Return the updated tracks."""
+        self.flush_model(['user_id', 'status', 'close_date', 'commission', 'commission_transferred'])
+        self.env.cr.execute("""
+            UPDATE user_commission_track t
+               SET commission_transferred = t.commission_transferred + s.share
+              FROM (
+                    SELECT c.id,
+                           LEAST(c.commission - c.commission_transferred,
+                                 v.amount - COALESCE(SUM(c.commission - c.commission_transferred) OVER (
+                                     PARTITION BY c.user_id
+                                     ORDER BY c.close_date, c.id
+                                     ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                                 ), 0)) AS share
+                      FROM user_commission_track c
+                      JOIN unnest(%s::int[], %s::float8[]) AS v(user_id, amount) ON v.user_id = c.user_id
+                     WHERE c.status = 'closed'
+                       AND c.commission > c.commission_transferred
+                   ) s
+             WHERE t.id = s.id
+               AND s.share > 0
+         RETURNING t.id
+        """, [list(amounts), list(amounts.values())])
+        tracks = self.browse([track_id for track_id, in self.env.cr.fetchall()])
+        tracks.invalidate_recordset(['commission_transferred'])
+        # Written in SQL: let the ORM recompute what depends on it, the coach
+        # balances and the track stamps
+        tracks.modified(['commission_transferred'])
+        return tracks
@@ -0,0 +1,107 @@
+"""What-if evaluation of commission slice tables.
+
+``CommissionSimulation`` holds the ``total_purchase`` and ``commission`` of
+a set of tracks as NumPy arrays, loaded once, and prices them with any
+number of candidate slice tables without touching the database::
+
+    simulation = CommissionSimulation.from_tracks(env, [('status', '=', 'closed')])
+    result = simulation.evaluate([(0.0, 1000.0, 0.05), (1000.0, 5000.0, 0.075)])
+
+A slice table is a list of ``(from_amount, to_amount, commission_percentage)``
+tuples. The lookup follows ``commission.slices._get_commission_percentage``:
+bounds are included, an amount on a boundary shared by two slices belongs to
+the first one of the table, and amounts outside every slice earn nothing.
+"""
+from odoo.exceptions import UserError
+from odoo.tools import SQL
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _require_numpy():
+    if np is None:
+        raise UserError("The commission simulator needs the numpy Python package.")
+
+
+class CommissionSimulation:
+
+    def __init__(self, user_ids, purchases, commissions):
+        _require_numpy()
+        self.purchases = np.asarray(purchases, dtype=np.float64)
+        self.commissions = np.asarray(commissions, dtype=np.float64)
+        self.coach_ids, self._coach_index = np.unique(np.asarray(user_ids, dtype=np.int64), return_inverse=True)
+        self.baseline = float(self.commissions.sum())
+
+    @classmethod
+    def from_tracks(cls, env, domain=None):
+        """Load the tracks matching ``domain`` in one query."""
+        _require_numpy()
+        query = env['user.commission.track']._search(domain or [])
+        env.cr.execute(SQL(
+            "SELECT user_id, total_purchase, commission FROM user_commission_track WHERE id IN %s",
+            query.subselect(),
+        ))
+        rows = env.cr.fetchall()
+        if not rows:
+            return cls([], [], [])
+        user_ids, purchases, commissions = zip(*rows)
+        return cls(user_ids, [purchase or 0.0 for purchase in purchases],
+                   [commission or 0.0 for commission in commissions])
+
+    def _rates(self, table):
+        """Return ``(rates, bands)``: the percentage of every track under
+        ``table`` and the index in ``table`` of its slice, -1 for none."""
+        if not table:
+            return np.zeros_like(self.purchases), np.full(self.purchases.shape, -1)
+        order = sorted(range(len(table)), key=lambda idx: (table[idx][0], idx))
+        froms = np.array([table[idx][0] for idx in order], dtype=np.float64)
+        tos = np.array([table[idx][1] for idx in order], dtype=np.float64)
+        pcts = np.array([table[idx][2] for idx in order], dtype=np.float64)
+        rank = np.array(order)
+
+        amounts = self.purchases
+        current = np.searchsorted(froms, amounts, side='right') - 1
+        previous = current - 1
+        safe_current = np.clip(current, 0, None)
+        safe_previous = np.clip(previous, 0, None)
+        in_current = (current >= 0) & (amounts <= tos[safe_current])
+        # Shared boundary: the amount is also the (inclusive) end of the
+        # previous slice, which wins when it comes first in the table
+        in_previous = (previous >= 0) & (froms[safe_previous] <= amounts) & (amounts <= tos[safe_previous])
+        use_previous = in_previous & (~in_current | (rank[safe_previous] < rank[safe_current]))
+        best = np.where(use_previous, previous, np.where(in_current, current, -1))
+        rates = np.where(best >= 0, pcts[np.clip(best, 0, None)], 0.0)
+        bands = np.where(best >= 0, rank[np.clip(best, 0, None)], -1)
+        return rates, bands
+
+    def evaluate(self, table, top=10):
+        """Price the tracks with ``table`` and return the payout, its change
+        against the current commissions, the number of tracks per slice of
+        ``table`` and the ``top`` coaches whose payout changes the most, as
+        ``(coach_id, change)`` pairs."""
+        rates, bands = self._rates(table)
+        commissions = self.purchases * rates
+        payout = float(commissions.sum())
+
+        band_counts = np.bincount(bands + 1, minlength=len(table) + 1)
+        per_coach = np.bincount(self._coach_index, weights=commissions - self.commissions,
+                                minlength=len(self.coach_ids))
+        top = min(top, len(per_coach))
+        if top:
+            largest = np.argpartition(-np.abs(per_coach), top - 1)[:top]
+            largest = largest[np.argsort(-np.abs(per_coach[largest]), kind='stable')]
+        else:
+            largest = []
+        return {
+            'payout': payout,
+            'change': payout - self.baseline,
+            'band_counts': [int(count) for count in band_counts[1:]],
+            'unmatched': int(band_counts[0]),
+            'top_changes': [(int(self.coach_ids[idx]), float(per_coach[idx])) for idx in largest],
+        }
+
+    def evaluate_many(self, tables, top=10):
+        return [self.evaluate(table, top=top) for table in tables]
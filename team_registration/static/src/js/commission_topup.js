@@ -13,9 +13,18 @@ function topUpWallet(btn) {
 
 
     // Make AJAX request using traditional form data for Odoo
+    // One key per top-up, kept until it succeeds, so that a double click or
+    // a retry is only credited once
+    if (!btn.dataset.idempotencyKey) {
+        btn.dataset.idempotencyKey = (window.crypto && window.crypto.randomUUID)
+            ? window.crypto.randomUUID()
+            : Date.now().toString(36) + Math.random().toString(36).slice(2);
+    }
+
     var formData = new FormData();
     formData.append('user_id', userId);
     formData.append('amount', amount);
+    formData.append('idempotency_key', btn.dataset.idempotencyKey);
     
     console.log("Making request to /commission/topup with form data");
     
@@ -37,6 +46,7 @@ function topUpWallet(btn) {
         console.log("Response received:", result);
         if (result.success) {
             console.log('Wallet topped up with ' + result.amount + ' JOD.');
+            delete btn.dataset.idempotencyKey;
 
             // Update commission balance in UI
             var commissionEl = document.getElementById("commission-balance");
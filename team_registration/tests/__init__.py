@@ -2,4 +2,7 @@ from . import test_commission_slices
 from . import test_user_commission_track
 from . import test_commission_controller
 from . import test_commission_period
-from . import test_model_diagnostic
\ No newline at end of file
+from . import test_model_diagnostic
+from . import test_commission_batch
+from . import test_commission_benchmark
+from . import test_team_registration
\ No newline at end of file
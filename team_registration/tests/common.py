@@ -0,0 +1,155 @@
+from odoo import Command, fields
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+from contextlib import contextmanager
+from datetime import timedelta
+import logging
+import random
+import time
+
+_logger = logging.getLogger(__name__)
+
+# (from_amount, to_amount, commission_percentage)
+DEFAULT_SLICES = (
+    (0.0, 1000.0, 5.0),
+    (1000.0, 5000.0, 7.5),
+    (5000.0, 1000000000.0, 10.0),
+)
+
+
+def run_commission_precommit(env):
+    """Run the hooks a commit would run, the ledger is synced there, then
+    the recompute cron for the coaches it queued."""
+    env.flush_all()
+    env.cr.precommit.run()
+    env['user.commission.queue']._process_queue()
+
+
+class CommissionBenchmarkCommon(AccountTestInvoicingCommon):
+    """Deterministic commission data generator and query budget helpers.
+
+    ``QUERY_BUDGETS`` maps a scenario to ``(fixed, per_coach)``: a scenario
+    may run at most ``fixed + per_coach * COACHES`` queries. Scenarios that
+    must not grow with the data declare ``per_coach = 0``.
+    """
+
+    COACHES = 20
+    REFERRALS = 10
+    INVOICES = 2
+    CLOSED_TRACKS = 3
+    SLICES = DEFAULT_SLICES
+    SEED = 42
+    QUERY_BUDGETS = {}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.today = fields.Date.today()
+        cls._generate_commission_data(
+            coaches=cls.COACHES,
+            referrals=cls.REFERRALS,
+            invoices=cls.INVOICES,
+            closed_tracks=cls.CLOSED_TRACKS,
+            slices=cls.SLICES,
+            seed=cls.SEED,
+        )
+
+    @classmethod
+    def _generate_commission_data(cls, coaches, referrals, invoices, closed_tracks, slices, seed):
+        """Create ``coaches`` coaches with ``referrals`` referred users each,
+        ``invoices`` paid invoices per partner spread over the last
+        ``closed_tracks`` 30-day cycles and the current one, one closed track
+        per past cycle and one active track per coach.
+
+        Amounts and dates only depend on ``seed``. Sets ``cls.coaches`` and
+        ``cls.bench_password``, the password of every generated coach.
+        """
+        rng = random.Random(seed)
+        Users = cls.env['res.users'].with_context(no_reset_password=True)
+        cls.env['commission.slices'].search([]).unlink()
+        cls.env['commission.slices'].create([{
+            'name': 'Benchmark Slice %s' % idx,
+            'from_amount': from_amount,
+            'to_amount': to_amount,
+            'commission_percentage': percentage,
+        } for idx, (from_amount, to_amount, percentage) in enumerate(slices)])
+
+        cls.bench_password = 'bench.password.1'
+        cls.coaches = Users.browse()
+        players = Users.browse()
+        for coach_idx in range(coaches):
+            coach = Users.create({
+                'name': 'Bench Coach %s' % coach_idx,
+                'login': 'bench.coach.%s@example.com' % coach_idx,
+                'password': cls.bench_password,
+                'is_coach': True,
+            })
+            cls.coaches |= coach
+            for idx in range(referrals):
+                players |= Users.create({
+                    'name': 'Bench Player %s.%s' % (coach_idx, idx),
+                    'login': 'bench.player.%s.%s@example.com' % (coach_idx, idx),
+                    'referred_by': coach.id,
+                })
+
+        cycle_days = 30
+        cycles = [
+            (cls.today - timedelta(days=cycle_days * age + cycle_days - 1), cls.today - timedelta(days=cycle_days * age))
+            for age in range(closed_tracks, 0, -1)
+        ] + [(cls.today - timedelta(days=cycle_days - 1), cls.today + timedelta(days=1))]
+
+        invoice_vals = []
+        for partner in (cls.coaches | players).partner_id:
+            for _idx in range(invoices):
+                cycle_start, _close = rng.choice(cycles)
+                invoice_vals.append({
+                    'move_type': 'out_invoice',
+                    'partner_id': partner.id,
+                    'invoice_date': cycle_start + timedelta(days=rng.randrange(cycle_days - 1)),
+                    'invoice_line_ids': [Command.create({
+                        'name': 'Benchmark line',
+                        'quantity': 1,
+                        'price_unit': rng.randrange(10, 500),
+                        'tax_ids': [],
+                    })],
+                })
+        moves = cls.env['account.move'].create(invoice_vals)
+        moves.action_post()
+        cls.env['account.payment.register'].with_context(
+            active_model='account.move', active_ids=moves.ids,
+        ).create({'group_payment': False})._create_payments()
+        run_commission_precommit(cls.env)
+
+        Track = cls.env['user.commission.track']
+        for seq, (start_date, close_date) in enumerate(cycles, start=1):
+            for coach in cls.coaches:
+                Track.create({
+                    'user_id': coach.id,
+                    'seq': seq,
+                    'start_date': start_date,
+                    'close_date': close_date,
+                    'status': 'active' if seq == len(cycles) else 'closed',
+                })
+        cls.env.flush_all()
+
+    @contextmanager
+    def _benchmark(self, scenario):
+        """Measure the wall time and queries of the block, log them and fail
+        when the queries go over the declared budget of ``scenario``."""
+        fixed, per_coach = self.QUERY_BUDGETS[scenario]
+        budget = fixed + per_coach * len(self.coaches)
+        self.env.flush_all()
+        self.env.invalidate_all()
+        start_queries = self.env.cr.sql_log_count
+        start = time.time()
+        yield
+        self.env.flush_all()
+        duration = time.time() - start
+        queries = self.env.cr.sql_log_count - start_queries
+        _logger.info(
+            "Commission benchmark %s: %.3fs, %s queries (budget %s, %s coaches)",
+            scenario, duration, queries, budget, len(self.coaches),
+        )
+        self.assertLessEqual(
+            queries, budget,
+            "Commission benchmark %s ran %s queries, over its budget of %s" % (scenario, queries, budget),
+        )
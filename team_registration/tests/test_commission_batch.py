@@ -0,0 +1,381 @@
+from odoo.tests import tagged
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+from odoo.addons.team_registration.metrics import TRACE_PARAM, commission_run
+from odoo.addons.team_registration.tests.common import run_commission_precommit
+from datetime import timedelta
+import json
+from odoo import Command, fields
+from odoo.exceptions import ValidationError
+from unittest.mock import patch
+
+
+@tagged('commission_batch', 'post_install', '-at_install')
+class TestCommissionBatch(AccountTestInvoicingCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.ResUsers = cls.env['res.users'].with_context(no_reset_password=True)
+        cls.UserCommissionTrack = cls.env['user.commission.track']
+
+        cls.env['commission.slices'].search([]).unlink()
+        cls.env['commission.slices'].create({
+            'name': 'Batch Slice',
+            'from_amount': 0.0,
+            'to_amount': 1000000.0,
+            'commission_percentage': 0.1,
+        })
+
+        cls.today = fields.Date.today()
+        cls.start_date = cls.today - timedelta(days=10)
+        cls.close_date = cls.today + timedelta(days=10)
+
+    def _create_coach(self, name, referrals=2):
+        coach = self.ResUsers.create({
+            'name': name,
+            'login': '%s@example.com' % name,
+            'is_coach': True,
+        })
+        for idx in range(referrals):
+            self.ResUsers.create({
+                'name': '%s player %s' % (name, idx),
+                'login': '%s.player.%s@example.com' % (name, idx),
+                'referred_by': coach.id,
+            })
+        return coach
+
+    def _create_track(self, coach):
+        return self.UserCommissionTrack.create({
+            'user_id': coach.id,
+            'seq': 1,
+            'start_date': self.start_date,
+            'close_date': self.close_date,
+            'status': 'active',
+        })
+
+    def _pay_invoice(self, partner, amount, invoice_date):
+        invoice = self.init_invoice(
+            'out_invoice', partner=partner, invoice_date=invoice_date, amounts=[amount], post=True,
+        )
+        self.env['account.payment.register'].with_context(
+            active_model='account.move', active_ids=invoice.ids,
+        ).create({'payment_date': invoice_date})._create_payments()
+        run_commission_precommit(self.env)
+        return invoice
+
+    def _expected_totals(self, track):
+        """Reference implementation: one search per partner, as before."""
+        def paid_total(partner):
+            invoices = self.env['account.move'].search([
+                ('move_type', '=', 'out_invoice'),
+                ('state', '=', 'posted'),
+                ('payment_state', 'in', ['paid', 'in_payment']),
+                ('partner_id', '=', partner.id),
+                ('invoice_date', '>=', track.start_date),
+                ('invoice_date', '<=', track.close_date),
+            ])
+            return sum(invoices.mapped('amount_untaxed'))
+
+        direct = paid_total(track.user_id.partner_id)
+        team = sum(paid_total(ref.partner_id) for ref in track.user_id.referred_users)
+        return direct, team
+
+    def _count_compute_queries(self, tracks):
+        self.env.invalidate_all()
+        tracks = tracks.browse(tracks.ids)
+        start = self.env.cr.sql_log_count
+        tracks._compute_purchases()
+        return self.env.cr.sql_log_count - start
+
+    def test_01_batch_totals_match_per_track_searches(self):
+        coach_a = self._create_coach('batch_coach_a')
+        coach_b = self._create_coach('batch_coach_b', referrals=3)
+        self._pay_invoice(coach_a.partner_id, 100.0, self.today)
+        self._pay_invoice(coach_a.referred_users[0].partner_id, 250.0, self.today)
+        self._pay_invoice(coach_b.referred_users[1].partner_id, 40.0, self.today)
+        self._pay_invoice(coach_b.referred_users[2].partner_id, 60.0, self.start_date)
+        # Outside of the window, must not be counted
+        self._pay_invoice(coach_b.partner_id, 999.0, self.start_date - timedelta(days=1))
+
+        tracks = self._create_track(coach_a) | self._create_track(coach_b)
+        tracks._compute_purchases()
+
+        for track in tracks:
+            direct, team = self._expected_totals(track)
+            self.assertAlmostEqual(track.direct_purchase, direct)
+            self.assertAlmostEqual(track.indirect_purchase, team)
+            self.assertAlmostEqual(track.total_purchase, direct + team)
+
+        self.assertAlmostEqual(tracks[0].total_purchase, 350.0)
+        self.assertAlmostEqual(tracks[1].total_purchase, 100.0)
+
+    def test_02_query_count_does_not_grow_with_tracks(self):
+        single = self._create_track(self._create_coach('batch_single'))
+        many = self.UserCommissionTrack.browse()
+        for idx in range(8):
+            many |= self._create_track(self._create_coach('batch_many_%s' % idx))
+
+        self.assertEqual(
+            self._count_compute_queries(single),
+            self._count_compute_queries(many),
+        )
+
+    def test_03_ledger_entries_per_beneficiary(self):
+        coach = self._create_coach('ledger_coach')
+        track = self._create_track(coach)
+        own = self._pay_invoice(coach.partner_id, 80.0, self.today)
+        team = self._pay_invoice(coach.referred_users[0].partner_id, 120.0, self.today)
+
+        Entry = self.env['user.commission.entry']
+        own_entry = Entry.search([('move_id', '=', own.id)])
+        team_entry = Entry.search([('move_id', '=', team.id)])
+        self.assertEqual(own_entry.kind, 'direct')
+        self.assertEqual(team_entry.kind, 'team')
+        self.assertEqual((own_entry | team_entry).user_id, coach)
+        self.assertEqual((own_entry | team_entry).track_id, track)
+        self.assertAlmostEqual(track.direct_purchase, 80.0)
+        self.assertAlmostEqual(track.indirect_purchase, 120.0)
+
+    def test_04_ledger_reversed_when_invoice_unpaid(self):
+        coach = self._create_coach('ledger_reverse_coach')
+        track = self._create_track(coach)
+        invoice = self._pay_invoice(coach.partner_id, 50.0, self.today)
+        self.assertAlmostEqual(track.total_purchase, 50.0)
+
+        invoice.line_ids.remove_move_reconcile()
+        run_commission_precommit(self.env)
+
+        entries = self.env['user.commission.entry'].search([('move_id', '=', invoice.id)])
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries.filtered('is_reversal').reversal_of_id, entries.filtered('is_reversed'))
+        self.assertAlmostEqual(sum(entries.mapped('amount')), 0.0)
+        self.assertAlmostEqual(track.total_purchase, 0.0)
+
+        # Syncing again is a no-op
+        self.env['user.commission.entry']._sync_moves(invoice)
+        self.assertEqual(self.env['user.commission.entry'].search_count([('move_id', '=', invoice.id)]), 2)
+
+    def test_05_write_only_queues_relevant_changes(self):
+        coach = self._create_coach('queue_coach')
+        self._create_track(coach)
+        invoice = self._pay_invoice(coach.partner_id, 30.0, self.today)
+        Queue = self.env['user.commission.queue']
+
+        invoice.write({'ref': 'Renamed'})
+        invoice.write({'invoice_date': invoice.invoice_date})
+        self.env.flush_all()
+        self.assertFalse(self.env.cr.precommit.data.get('team_registration.commission_moves'))
+        self.assertFalse(Queue.search_count([('user_id', '=', coach.id)]))
+
+    def test_06_queue_coalesces_coaches(self):
+        coach = self._create_coach('queue_coalesce_coach')
+        track = self._create_track(coach)
+        Queue = self.env['user.commission.queue']
+
+        Queue._enqueue([coach.id, coach.id])
+        Queue._enqueue([coach.id])
+        self.assertEqual(Queue.search_count([('user_id', '=', coach.id)]), 1)
+
+        self.assertGreaterEqual(Queue._process_queue(), 1)
+        self.assertFalse(Queue.search_count([('user_id', '=', coach.id)]))
+        self.assertEqual(track.status, 'active')
+
+    def test_07_coach_map_cached_and_invalidated(self):
+        coach = self._create_coach('map_coach', referrals=1)
+        player = coach.referred_users
+        Users = self.env['res.users']
+        partner_ids = [coach.partner_id.id, player.partner_id.id]
+
+        self.assertEqual(Users._get_commission_coaches(partner_ids), {
+            coach.partner_id.id: ((coach.id, 'direct'),),
+            player.partner_id.id: ((coach.id, 'team'),),
+        })
+        start = self.env.cr.sql_log_count
+        Users._get_commission_coaches(partner_ids * 5000)
+        self.assertEqual(self.env.cr.sql_log_count, start)
+
+        other_coach = self._create_coach('map_other_coach', referrals=0)
+        player.referred_by = other_coach
+        self.assertEqual(
+            Users._get_commission_coaches([player.partner_id.id])[player.partner_id.id],
+            ((other_coach.id, 'team'),),
+        )
+
+    def test_08_referral_path_follows_tree(self):
+        top = self._create_coach('path_top', referrals=0)
+        middle = self._create_coach('path_middle', referrals=1)
+        player = middle.referred_users
+        other = self._create_coach('path_other', referrals=0)
+
+        middle.referred_by = top
+        self.assertEqual(player.referral_path, '%s/%s/%s/' % (top.id, middle.id, player.id))
+        self.assertEqual(top._get_referral_subtree(), top | middle | player)
+
+        # Moving a user moves its whole downline
+        middle.referred_by = other
+        self.assertEqual(player.referral_path, '%s/%s/%s/' % (other.id, middle.id, player.id))
+        self.assertEqual(top._get_referral_subtree(), top)
+        self.assertEqual(other._get_referral_subtree(), other | middle | player)
+
+        with self.assertRaises(ValidationError):
+            other.referred_by = player
+
+    def test_09_team_depth_counts_whole_downline(self):
+        top = self._create_coach('depth_top', referrals=0)
+        middle = self._create_coach('depth_middle', referrals=1)
+        middle.referred_by = top
+        top_track = self._create_track(top)
+        middle_track = self._create_track(middle)
+        self._pay_invoice(middle.partner_id, 10.0, self.today)
+        self._pay_invoice(middle.referred_users.partner_id, 20.0, self.today)
+
+        # One level: the player only counts for its own coach
+        self.assertAlmostEqual(top_track.indirect_purchase, 10.0)
+        self.assertAlmostEqual(middle_track.indirect_purchase, 20.0)
+
+        Entry = self.env['user.commission.entry']
+        top.company_id.commission_team_depth = 2
+        run_commission_precommit(self.env)
+        self.assertAlmostEqual(top_track.indirect_purchase, 30.0)
+        self.assertAlmostEqual(middle_track.indirect_purchase, 20.0)
+        self.assertEqual(dict(Entry._read_group(
+            [('user_id', 'in', (top | middle).ids), ('kind', '=', 'team')], ['user_id'], ['amount:sum'],
+        )), {top: 30.0, middle: 20.0})
+
+        # Going back to one level reverses the extra team entry, and keeps
+        # the rest of the ledger and its history
+        entry_ids = set(Entry.search([('user_id', 'in', (top | middle).ids)]).ids)
+        top.company_id.commission_team_depth = 1
+        run_commission_precommit(self.env)
+        self.assertAlmostEqual(top_track.indirect_purchase, 10.0)
+        self.assertAlmostEqual(middle_track.indirect_purchase, 20.0)
+        entries = Entry.search([('user_id', 'in', (top | middle).ids)])
+        self.assertLessEqual(entry_ids, set(entries.ids))
+        reversal = entries.filtered('is_reversal')
+        self.assertEqual(len(reversal), 1)
+        self.assertEqual((reversal.user_id, reversal.kind, reversal.amount), (top, 'team', -20.0))
+
+    def test_10_team_page_single_query(self):
+        coach = self._create_coach('team_page_coach', referrals=3)
+        first, second, third = coach.referred_users.sorted('id')
+        for start, close in [(self.start_date, self.today - timedelta(days=5)),
+                             (self.today - timedelta(days=3), self.today)]:
+            self.UserCommissionTrack.create({
+                'user_id': coach.id,
+                'seq': 1,
+                'start_date': start,
+                'close_date': close,
+                'status': 'closed',
+            })
+        self._pay_invoice(first.partner_id, 10.0, self.start_date)
+        self._pay_invoice(second.partner_id, 30.0, self.today)
+        self._pay_invoice(second.partner_id, 5.0, self.today - timedelta(days=1))
+        # Between the two closed windows, not counted
+        self._pay_invoice(third.partner_id, 99.0, self.today - timedelta(days=4))
+
+        self.assertEqual(coach._read_team_purchase_page(), (3, [
+            (second.id, 35.0), (first.id, 10.0), (third.id, 0.0),
+        ]))
+        self.assertEqual(coach._read_team_purchase_page(order='total_asc', limit=2, offset=1), (3, [
+            (first.id, 10.0), (second.id, 35.0),
+        ]))
+        self.assertEqual(coach._read_team_purchase_page(offset=3), (3, []))
+
+        with self.assertQueryCount(1):
+            coach._read_team_purchase_page()
+
+    def test_11_run_summary_and_trace(self):
+        coach = self._create_coach('metrics_coach')
+        self._create_track(coach)
+        self.env['user.commission.queue']._enqueue(coach.ids)
+
+        with self.assertLogs('odoo.addons.team_registration.metrics', 'INFO') as logs:
+            self.env['user.commission.queue']._process_queue()
+        summary = json.loads(logs.records[-1].args[0])
+        self.assertEqual(summary['run'], 'process_commission_queue')
+        self.assertEqual(summary['counters']['coaches'], 1)
+        self.assertEqual(summary['counters']['tracks_computed'], 1)
+        self.assertIn('recompute_purchases', summary['timers'])
+
+        # Per-record lines are only emitted when tracing is enabled
+        with self.assertLogs('odoo.addons.team_registration.metrics', 'INFO') as logs:
+            with commission_run(self.env, 'trace_off') as run:
+                run.trace("coach %s", coach.id)
+        self.assertEqual(len(logs.records), 1)
+
+        self.env['ir.config_parameter'].sudo().set_param(TRACE_PARAM, '1')
+        with self.assertLogs('odoo.addons.team_registration.metrics', 'INFO') as logs:
+            with commission_run(self.env, 'trace_on') as run:
+                run.trace("coach %s", coach.id)
+        self.assertEqual(logs.output[0].split(':', 2)[2], "trace_on: coach %s" % coach.id)
+        self.assertEqual(len(logs.records), 2)
+
+    def test_12_invoice_batch_create_opens_missing_tracks(self):
+        new_coach = self._create_coach('import_new', referrals=1)
+        rolled_coach = self._create_coach('import_rolled', referrals=0)
+        covered_coach = self._create_coach('import_covered', referrals=0)
+        self.UserCommissionTrack.create({
+            'user_id': rolled_coach.id,
+            'seq': 4,
+            'start_date': self.start_date - timedelta(days=30),
+            'close_date': self.start_date,
+            'status': 'closed',
+        })
+        covered_track = self._create_track(covered_coach)
+
+        partners = (new_coach.partner_id | new_coach.referred_users.partner_id
+                    | rolled_coach.partner_id | covered_coach.partner_id)
+        self.env['account.move'].create([{
+            'move_type': 'out_invoice',
+            'partner_id': partner.id,
+            'invoice_date': self.today,
+            'invoice_line_ids': [Command.create({'name': 'Import line', 'quantity': 1, 'price_unit': 10.0})],
+        } for partner in partners for _idx in range(2)])
+
+        new_track = self.UserCommissionTrack.search([('user_id', '=', new_coach.id)])
+        self.assertEqual(len(new_track), 1)
+        self.assertRecordValues(new_track, [{'seq': 1, 'start_date': self.today, 'status': 'active'}])
+
+        rolled_track = self.UserCommissionTrack.search([('user_id', '=', rolled_coach.id), ('status', '=', 'active')])
+        self.assertRecordValues(rolled_track, [{
+            'seq': 5, 'start_date': self.start_date + timedelta(days=1), 'status': 'active',
+        }])
+        self.assertEqual(self.UserCommissionTrack.search([('user_id', '=', covered_coach.id)]), covered_track)
+
+    def test_13_moving_a_referral_moves_its_entries(self):
+        old_coach = self._create_coach('move_old_coach', referrals=1)
+        new_coach = self._create_coach('move_new_coach', referrals=0)
+        player = old_coach.referred_users
+        old_track = self._create_track(old_coach)
+        new_track = self._create_track(new_coach)
+        invoice = self._pay_invoice(player.partner_id, 45.0, self.today)
+        self.assertAlmostEqual(old_track.indirect_purchase, 45.0)
+
+        player.referred_by = new_coach
+        run_commission_precommit(self.env)
+        self.assertAlmostEqual(old_track.indirect_purchase, 0.0)
+        self.assertAlmostEqual(new_track.indirect_purchase, 45.0)
+        entries = self.env['user.commission.entry'].search([('move_id', '=', invoice.id)])
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(entries.filtered('is_reversal').user_id, old_coach)
+
+    def test_14_coach_queued_again_during_recompute(self):
+        coach = self._create_coach('queue_race_coach')
+        self._create_track(coach)
+        Queue = self.env['user.commission.queue']
+        Track = type(self.UserCommissionTrack)
+        recompute = Track._recompute_purchases
+        recomputed = []
+
+        def recompute_and_enqueue(tracks):
+            recomputed.append(tracks.user_id.ids)
+            if len(recomputed) == 1:
+                # A payment committed while the first claim is recomputed
+                Queue._enqueue(coach.ids)
+            return recompute(tracks)
+
+        Queue._enqueue(coach.ids)
+        with patch.object(Track, '_recompute_purchases', recompute_and_enqueue):
+            self.assertEqual(Queue._process_queue(), 2)
+        self.assertEqual(recomputed, [coach.ids, coach.ids])
+        self.assertFalse(Queue.search_count([('user_id', '=', coach.id)]))
@@ -0,0 +1,94 @@
+from odoo.tests import tagged, HttpCase
+from datetime import timedelta
+from unittest import skipIf
+import logging
+import time
+
+from .common import CommissionBenchmarkCommon
+from .. import simulator
+from ..simulator import CommissionSimulation
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('commission_benchmark', '-standard', 'post_install', '-at_install')
+class TestCommissionBenchmark(CommissionBenchmarkCommon, HttpCase):
+    """Scaling of the commission engine on generated data.
+
+    Not part of the standard run, use ``--test-tags commission_benchmark``.
+    Wall times and query counts are logged for every scenario, going over a
+    query budget fails the test: raise a budget deliberately, never to make
+    an N+1 pass.
+    """
+
+    REFERRALS = 25
+    QUERY_BUDGETS = {
+        'compute_purchases': (30, 0),
+        'cron_rollover': (60, 0),
+        'cron_auto_topup': (60, 1),
+        'page_my_team': (60, 0),
+        'page_commission_details': (60, 0),
+    }
+
+    def test_01_compute_purchases(self):
+        tracks = self.env['user.commission.track'].search([('user_id', 'in', self.coaches.ids)])
+        with self._benchmark('compute_purchases'):
+            tracks.browse(tracks.ids)._compute_purchases()
+
+    def test_02_cron_rollover(self):
+        Track = self.env['user.commission.track']
+        active = Track.search([('user_id', 'in', self.coaches.ids), ('status', '=', 'active')])
+        # Expire the active tracks without triggering their recompute
+        self.env.cr.execute(
+            "UPDATE user_commission_track SET close_date = %s WHERE id IN %s",
+            [self.today - timedelta(days=1), tuple(active.ids)],
+        )
+        Track.invalidate_model(['close_date'])
+        with self._benchmark('cron_rollover'):
+            Track.cron_process_commission_tracks()
+        self.assertEqual(set(active.mapped('status')), {'closed'})
+        self.assertEqual(
+            Track.search_count([('user_id', 'in', self.coaches.ids), ('status', '=', 'active')]),
+            len(self.coaches),
+        )
+
+    def test_03_cron_auto_topup(self):
+        if not self.env['loyalty.program']._get_ewallet_program():
+            self.env['loyalty.program'].create({
+                'name': 'Benchmark eWallet',
+                'program_type': 'ewallet',
+            })
+        self.assertTrue(self.coaches.filtered('commission_balance'))
+        with self._benchmark('cron_auto_topup'):
+            self.env['user.commission.track'].cron_auto_commission_topup()
+        self.assertFalse(self.coaches.filtered('commission_balance'))
+
+    def _benchmark_page(self, scenario, url):
+        coach = self.coaches[0]
+        self.authenticate(coach.login, self.bench_password)
+        # Warm up the template and registry caches first
+        self.assertEqual(self.url_open(url).status_code, 200)
+        with self._benchmark(scenario):
+            response = self.url_open(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_04_page_my_team(self):
+        self._benchmark_page('page_my_team', '/my/team')
+
+    def test_05_page_commission_details(self):
+        self._benchmark_page('page_commission_details', '/my/commission-details')
+
+    @skipIf(simulator.np is None, "numpy is not installed")
+    def test_06_simulator_million_tracks(self):
+        """Pricing a million tracks with a candidate table, no database involved."""
+        rng = simulator.np.random.default_rng(self.SEED)
+        tracks = 1_000_000
+        simulation = CommissionSimulation(
+            rng.integers(1, 50_000, tracks), rng.uniform(0, 20_000, tracks), rng.uniform(0, 500, tracks))
+        table = [(from_amount, to_amount, percentage / 100) for from_amount, to_amount, percentage in self.SLICES]
+        start = time.time()
+        result = simulation.evaluate(table)
+        duration = time.time() - start
+        _logger.info("Commission benchmark simulator: %.3fs for %s tracks", duration, tracks)
+        self.assertEqual(sum(result['band_counts']) + result['unmatched'], tracks)
+        self.assertLess(duration, 1.0)
@@ -1,8 +1,13 @@
 from odoo.tests import tagged, HttpCase
 from odoo import http
+from odoo.addons.base.models.ir_mail_server import IrMailServer
+from odoo.addons.mail.models.mail_template import MailTemplate
 from datetime import datetime, timedelta
+from unittest.mock import patch
 import json
+import re
 import logging
+import time
 
 _logger = logging.getLogger(__name__)
 
@@ -177,4 +182,144 @@ class TestCommissionController(HttpCase):
                 'from_amount': 500000.0,  # Overlaps with setUp slice
                 'to_amount': 600000.0,
                 'commission_percentage': 5.0,
-            })
\ No newline at end of file
+            })
+
+    def test_10_commission_details_history_keyset_paging(self):
+        """Test the summary aggregate and the keyset paged wallet history"""
+        self.UserCommissionTrack.create({
+            'user_id': self.coach_user.id,
+            'seq': 1,
+            'start_date': datetime.now().date() - timedelta(days=30),
+            'close_date': datetime.now().date() - timedelta(days=1),
+            'status': 'closed',
+        }).write({'commission': 40.0, 'commission_transferred': 15.0})
+        card = self.LoyaltyCard.create({
+            'partner_id': self.coach_user.partner_id.id,
+            'program_id': self.ewallet_program.id,
+            'points': 0.0,
+        })
+        history = self.env['loyalty.history'].create([{
+            'card_id': card.id,
+            'description': 'Payment %s' % idx,
+            'used': 1.0,
+        } for idx in range(12)]).sorted('id', reverse=True)
+
+        self.authenticate(self.coach_user.login, 'test12345')
+        response = self.url_open('/my/commission-details')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('25.00', response.text)
+        self.assertIn('history_before=%s' % history[9].id, response.text)
+        self.assertTrue(re.search(r'Payment 2\s', response.text))
+        self.assertFalse(re.search(r'Payment 1\s', response.text))
+
+        response = self.url_open('/my/commission-details?history_before=%s' % history[9].id)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(re.search(r'Payment 1\s', response.text))
+        self.assertTrue(re.search(r'Payment 0\s', response.text))
+        self.assertFalse(re.search(r'Payment 2\s', response.text))
+        self.assertNotIn('history_before=%s' % history[11].id, response.text)
+
+    def test_11_home_served_from_snapshot_with_http_caching(self):
+        """Test the snapshot backed portal home and its conditional requests"""
+        track = self.UserCommissionTrack.create({
+            'user_id': self.coach_user.id,
+            'seq': 1,
+            'start_date': datetime.now().date() - timedelta(days=5),
+            'close_date': datetime.now().date() + timedelta(days=5),
+            'status': 'active',
+        })
+        self.env.flush_all()
+        self.assertEqual(self.coach_user.commission_active_track_id, track)
+
+        self.authenticate(self.coach_user.login, 'test12345')
+        response = self.url_open('/my/home')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertTrue(etag)
+        self.assertTrue(response.headers['Last-Modified'])
+
+        response = self.url_open('/my/home', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # A closed commission changes the balance, hence the page, without
+        # touching the stamp of the active track
+        version = track.snapshot_version
+        closed = self.UserCommissionTrack.create({
+            'user_id': self.coach_user.id,
+            'seq': 0,
+            'start_date': datetime.now().date() - timedelta(days=30),
+            'close_date': datetime.now().date() - timedelta(days=6),
+            'status': 'closed',
+        })
+        closed.write({'commission': 12.0})
+        self.env.flush_all()
+        self.assertEqual(track.snapshot_version, version)
+        self.assertEqual(self.coach_user.commission_active_track_id, track)
+
+        response = self.url_open('/my/home', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        # A transfer done in SQL still goes through the ORM dependencies
+        closed_version = closed.snapshot_version
+        self.UserCommissionTrack._spread_commission_transfer({self.coach_user.id: 5.0})
+        self.env.flush_all()
+        self.assertGreater(closed.snapshot_version, closed_version)
+        self.assertAlmostEqual(self.coach_user.commission_balance, 7.0)
+
+    def test_12_signup_does_not_wait_for_smtp(self):
+        """Test that the welcome mail is queued, with an SMTP stand-in that
+        takes ``smtp_delay`` seconds per message, against the synchronous
+        send the signup used to force. The delay is kept short, the queued
+        send is asserted by no message reaching the stand-in"""
+        smtp_delay = 0.05
+        sent = []
+
+        def slow_send_email(server, message, *args, **kwargs):
+            time.sleep(smtp_delay)
+            sent.append(message['To'])
+            return message['Message-Id']
+
+        send_mail = MailTemplate.send_mail
+
+        def send_mail_now(template, res_id, force_send=False, *args, **kwargs):
+            return send_mail(template, res_id, True, *args, **kwargs)
+
+        def signup(login):
+            # The referral of the invitation link is kept in the session
+            self.logout()
+            self.url_open('/web/signup?ref=%s' % self.coach_user.id)
+            start = time.time()
+            response = self.url_open('/web/signup', data={
+                'login': login,
+                'name': 'Signup Referral',
+                'password': 'signup.password.1',
+                'confirm_password': 'signup.password.1',
+                'csrf_token': http.Request.csrf_token(self),
+            }, allow_redirects=False)
+            self.assertEqual(response.status_code, 303)
+            return time.time() - start
+
+        self.env['ir.config_parameter'].sudo().set_param('auth_signup.invitation_scope', 'b2c')
+        with patch.object(IrMailServer, 'send_email', slow_send_email):
+            # Before: the welcome mail sent within the request
+            with patch.object(MailTemplate, 'send_mail', send_mail_now):
+                latency_before = signup('signup.before@example.com')
+            self.assertEqual(len(sent), 1)
+            self.assertGreaterEqual(latency_before, smtp_delay)
+            sent.clear()
+
+            # After: queued for the mail cron
+            latency = signup('signup.referral@example.com')
+            _logger.info("Signup latency with a %.2fs SMTP stand-in: %.3fs before, %.3fs after",
+                         smtp_delay, latency_before, latency)
+
+            user = self.env['res.users'].search([('login', '=', 'signup.referral@example.com')])
+            self.assertEqual(user.referred_by, self.coach_user)
+            self.assertFalse(sent)
+            self.assertTrue(self.env['mail.mail'].search([
+                ('model', '=', 'res.users'), ('res_id', '=', user.id), ('state', '=', 'outgoing'),
+            ]))
+
+            self.env['mail.mail'].process_email_queue()
+            self.assertEqual(len(sent), 1)
@@ -1,5 +1,10 @@
 from odoo.tests import tagged, TransactionCase
 from odoo.exceptions import ValidationError
+from odoo import fields
+from odoo.addons.team_registration import simulator
+from odoo.addons.team_registration.simulator import CommissionSimulation
+from datetime import timedelta
+from unittest import skipIf
 
 
 @tagged('commission', 'commission_slices')
@@ -242,4 +247,185 @@ class TestCommissionSlices(TransactionCase):
         slice3.write({'commission_percentage': 12.0})
 
         # Sequence should remain the same
-        self.assertEqual(slice3.slice_seq, original_sequence)
\ No newline at end of file
+        self.assertEqual(slice3.slice_seq, original_sequence)
+
+    def test_13_cached_percentage_lookup_matches_search(self):
+        """Test the bisect lookup against the domain search it replaces"""
+        touching = self.CommissionSlices.create({
+            'name': 'Touching Slice',
+            'from_amount': 105000.0,
+            'to_amount': 110000.0,
+            'commission_percentage': 9.0,
+        })
+        amounts = [0.0, 99999.99, 100000.0, 100500.0, 101000.0, 101000.005,
+                   101000.01, 105000.0, 107000.0, 110000.0, 110000.01]
+        for amount in amounts:
+            with self.subTest(amount=amount):
+                expected = self.CommissionSlices.search([
+                    ('from_amount', '<=', amount),
+                    ('to_amount', '>=', amount),
+                ], limit=1)
+                self.assertEqual(
+                    self.CommissionSlices._get_commission_percentage(amount),
+                    expected.commission_percentage if expected else 0.0,
+                )
+        self.assertEqual(self.CommissionSlices._get_commission_percentage(107000.0), touching.commission_percentage)
+
+    def test_14_cached_percentage_lookup_invalidated(self):
+        """Test that slice changes are visible to the cached lookup"""
+        self.assertEqual(self.CommissionSlices._get_commission_percentage(100500.0), 5.0)
+
+        self.slice1.write({'commission_percentage': 6.0})
+        self.assertEqual(self.CommissionSlices._get_commission_percentage(100500.0), 6.0)
+
+        self.slice1.unlink()
+        self.assertEqual(self.CommissionSlices._get_commission_percentage(100500.0), 0.0)
+
+    def test_15_overlap_rejected_on_write(self):
+        """Test that moving a slice onto another one is rejected"""
+        with self.assertRaises(ValidationError):
+            self.slice2.write({'from_amount': 100900.0})
+
+    def test_16_slice_versions_by_effective_date(self):
+        """Test that a new plan version only prices tracks starting after it"""
+        Version = self.env['commission.slice.version']
+        today = fields.Date.today()
+        current = self.slice1.version_id
+        self.assertEqual(self.slice2.version_id, current)
+        self.assertEqual(Version._get_version_id_for_date(today), current.id)
+
+        coach = self.env['res.users'].create({
+            'name': 'Version Coach',
+            'login': 'version.coach@example.com',
+            'is_coach': True,
+        })
+        Track = self.env['user.commission.track']
+        old_track = Track.create({
+            'user_id': coach.id,
+            'seq': 1,
+            'start_date': today - timedelta(days=10),
+            'close_date': today + timedelta(days=20),
+            'status': 'active',
+        })
+        self.assertEqual(old_track.slice_version_id, current)
+
+        # Same amounts, other rates and a range that overlaps slice1: allowed
+        # in another version
+        new_version = Version.create({
+            'name': 'Next Plan',
+            'date_from': today + timedelta(days=21),
+            'slice_ids': [(0, 0, {
+                'name': 'Next Slice',
+                'from_amount': 100000.0,
+                'to_amount': 102000.0,
+                'commission_percentage': 8.0,
+            })],
+        })
+        self.assertEqual(current.date_to, today + timedelta(days=20))
+        self.assertFalse(new_version.date_to)
+
+        new_track = Track.create({
+            'user_id': coach.id,
+            'seq': 2,
+            'start_date': today + timedelta(days=21),
+            'close_date': today + timedelta(days=51),
+            'status': 'active',
+        })
+        self.assertEqual(old_track.slice_version_id, current)
+        self.assertEqual(new_track.slice_version_id, new_version)
+        self.assertEqual(self.CommissionSlices._get_commission_percentage(100500.0, current.id), 5.0)
+        self.assertEqual(self.CommissionSlices._get_commission_percentage(100500.0, new_version.id), 8.0)
+        self.assertEqual(self.CommissionSlices._get_commission_percentage(100500.0), 5.0)
+
+        # Moving the version start over an open track reprices it
+        new_version.date_from = today - timedelta(days=10)
+        self.assertEqual(old_track.slice_version_id, new_version)
+
+        with self.assertRaises(ValidationError):
+            self.CommissionSlices.create({
+                'name': 'Overlap In Version',
+                'version_id': new_version.id,
+                'from_amount': 101000.0,
+                'to_amount': 103000.0,
+                'commission_percentage': 9.0,
+            })
+
+    def test_17_version_copy(self):
+        """Test that copying a version copies its slices to a later date"""
+        current = self.slice1.version_id
+        copy = current.copy()
+        self.assertGreater(copy.date_from, current.date_from)
+        self.assertEqual(
+            sorted(copy.slice_ids.mapped('from_amount')),
+            sorted(current.slice_ids.mapped('from_amount')),
+        )
+
+    @skipIf(simulator.np is None, "numpy is not installed")
+    def test_18_simulator_matches_live_lookup(self):
+        """Test that the vectorized simulator prices like the live slices"""
+        self.CommissionSlices.create({
+            'name': 'Touching Slice',
+            'from_amount': 105000.0,
+            'to_amount': 110000.0,
+            'commission_percentage': 9.0,
+        })
+        version = self.slice1.version_id
+        amounts = [0.0, 99999.99, 100000.0, 100500.0, 101000.0, 101000.005,
+                   101000.01, 105000.0, 107000.0, 110000.0, 110000.01]
+        simulation = CommissionSimulation(range(len(amounts)), amounts, [0.0] * len(amounts))
+        result = simulation.evaluate(version._get_simulation_table(), top=len(amounts))
+        for coach_id, change in result['top_changes']:
+            amount = amounts[coach_id]
+            with self.subTest(amount=amount):
+                self.assertAlmostEqual(
+                    change, amount * self.CommissionSlices._get_commission_percentage(amount, version.id))
+        self.assertEqual(result['unmatched'], 4)
+        self.assertEqual(sum(result['band_counts']), len(amounts) - 4)
+
+    @skipIf(simulator.np is None, "numpy is not installed")
+    def test_19_simulator_from_tracks(self):
+        """Test the what-if payout of stored tracks against their commission"""
+        coach = self.env['res.users'].create({
+            'name': 'Simulated Coach',
+            'login': 'simulated.coach@example.com',
+            'is_coach': True,
+        })
+        track = self.env['user.commission.track'].create({
+            'user_id': coach.id,
+            'seq': 1,
+            'start_date': fields.Date.today() - timedelta(days=40),
+            'close_date': fields.Date.today() - timedelta(days=10),
+            'status': 'closed',
+        })
+        track.write({'total_purchase': 100500.0, 'commission': 1000.0})
+
+        simulation = CommissionSimulation.from_tracks(self.env, [('id', '=', track.id)])
+        self.assertEqual(simulation.baseline, 1000.0)
+        low, high = simulation.evaluate_many([
+            [(100000.0, 101000.0, 0.01)],
+            [(0.0, 100000.0, 0.01), (100000.0, 200000.0, 0.02)],
+        ])
+        self.assertAlmostEqual(low['payout'], 1005.0)
+        self.assertEqual(low['top_changes'], [(coach.id, low['change'])])
+        self.assertAlmostEqual(high['payout'], 2010.0)
+        self.assertEqual(high['band_counts'], [0, 1])
+        # Nothing was written
+        self.assertEqual(track.commission, 1000.0)
+
+
+    def test_20_default_version_has_no_side_effect(self):
+        """Test that the version default only reads existing versions"""
+        Version = self.env['commission.slice.version']
+        current = self.slice1.version_id
+        self.assertEqual(self.CommissionSlices.default_get(['version_id'])['version_id'], current.id)
+
+        Version.search([]).unlink()
+        self.assertFalse(self.CommissionSlices.default_get(['version_id']).get('version_id'))
+        self.assertFalse(Version.search_count([]))
+        with self.assertRaises(ValidationError):
+            self.CommissionSlices.create({
+                'name': 'Orphan Slice',
+                'from_amount': 0.0,
+                'to_amount': 100.0,
+                'commission_percentage': 0.05,
+            })
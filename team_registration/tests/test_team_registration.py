@@ -0,0 +1,199 @@
+from odoo.tests import tagged, TransactionCase
+from odoo.exceptions import ValidationError
+from odoo.tools import mute_logger
+from odoo.addons.team_registration.models.res_users import format_national_phone, normalize_phone
+from psycopg2 import IntegrityError
+from unittest.mock import patch
+import base64
+
+
+@tagged('team_registration', 'post_install', '-at_install')
+class TestTeamRegistration(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.TeamRegistration = cls.env['team.registration']
+        cls.referrer = cls.env['res.users'].with_context(no_reset_password=True).create({
+            'name': 'Registration Referrer',
+            'login': 'registration.referrer@example.com',
+            'is_coach': True,
+        })
+        cls.base_url = cls.env['ir.config_parameter'].sudo().get_param('web.base.url')
+
+    def _create_registrations(self, count):
+        return self.TeamRegistration.create([{
+            'name': 'Applicant %s' % idx,
+            'phone': '+96279000%04d' % idx,
+            'email': 'applicant.%s@example.com' % idx,
+            'password': 'applicant.password',
+            'role': ('coach', 'nutritionist', 'owner')[idx % 3],
+            'referred_by': self.referrer.id,
+        } for idx in range(count)])
+
+    def test_01_batch_approval_creates_users(self):
+        registrations = self._create_registrations(3)
+        registrations.action_approve()
+
+        self.assertEqual(set(registrations.mapped('state')), {'approved'})
+        users = registrations.user_id
+        self.assertEqual(len(users), 3)
+        for registration in registrations:
+            user = registration.user_id
+            self.assertRecordValues(user, [{
+                'login': registration.phone,
+                'mobile': registration.phone.lstrip('+'),
+                'referred_by': self.referrer.id,
+                'is_coach': registration.role == 'coach',
+                'is_nutritionist': registration.role == 'nutritionist',
+                'is_owner': registration.role == 'owner',
+                'referral_link': f"{self.base_url}/web/signup?mobile_field=true&ref={user.id}",
+                'referral_path': '%s%s/' % (self.referrer.referral_path, user.id),
+            }])
+            self.assertEqual(registration.invitation_link, user.referral_link)
+            self.assertTrue(user.has_group('base.group_portal'))
+
+        # Approving again does not create the users twice
+        registrations.action_approve()
+        self.assertEqual(registrations.user_id, users)
+
+    def test_02_large_selection_approved_in_background(self):
+        registrations = self._create_registrations(3)
+        with patch.object(type(self.TeamRegistration), '_approval_sync_limit', 1):
+            action = registrations.action_approve()
+
+        self.assertEqual(action['tag'], 'display_notification')
+        self.assertEqual(set(registrations.mapped('state')), {'approving'})
+        self.assertFalse(registrations.user_id)
+
+        self.TeamRegistration._cron_approve_registrations(batch_size=2)
+        self.assertEqual(registrations.mapped('state'), ['approved', 'approved', 'approving'])
+
+        self.TeamRegistration._cron_approve_registrations(batch_size=2)
+        self.assertEqual(set(registrations.mapped('state')), {'approved'})
+        self.assertEqual(len(registrations.user_id), 3)
+
+    def _create_managers(self, count):
+        group = self.env.ref('team_registration.group_team_registration_manager')
+        return self.env['res.users'].with_context(no_reset_password=True).create([{
+            'name': 'Approval Manager %s' % idx,
+            'login': 'approval.manager.%s@example.com' % idx,
+            'groups_id': [(4, self.env.ref('base.group_user').id), (4, group.id)],
+        } for idx in range(count)])
+
+    def _manager_activities(self, managers):
+        return self.env['mail.activity'].search([
+            ('res_model', '=', 'team.registration'),
+            ('user_id', 'in', managers.ids),
+        ])
+
+    def test_03_activities_created_in_batch(self):
+        managers = self._create_managers(2)
+        registrations = self.TeamRegistration.create([{
+            'name': 'Burst Applicant %s' % idx,
+            'phone': '+96278000%04d' % idx,
+            'password': 'applicant.password',
+            'role': 'coach',
+        } for idx in range(3)])
+
+        activities = self._manager_activities(managers)
+        self.assertEqual(len(activities), 6)
+        self.assertEqual(set(activities.mapped('res_id')), set(registrations.ids))
+        self.assertTrue(all(registrations.mapped('approval_notified')))
+
+    def test_04_approval_digest(self):
+        managers = self._create_managers(2)
+        self.env.company.registration_activity_digest = True
+        registrations = self._create_registrations(3)
+        self.assertFalse(self._manager_activities(managers))
+
+        self.TeamRegistration._cron_approval_digest()
+        activities = self._manager_activities(managers)
+        self.assertEqual(len(activities), 2)
+        self.assertEqual(activities.user_id, managers)
+        self.assertEqual(set(activities.mapped('res_id')), {registrations[0].id})
+        self.assertIn('Applicant 2', activities[0].note)
+
+        # Nothing new since the previous digest
+        self.TeamRegistration._cron_approval_digest()
+        self.assertEqual(self._manager_activities(managers), activities)
+
+    def test_05_normalized_phone(self):
+        self.assertEqual(normalize_phone('+962 79-000 0001'), '962790000001')
+        self.assertEqual(normalize_phone('00962790000001'), '962790000001')
+        self.assertFalse(normalize_phone(''))
+        # The national trunk "0" is not part of the number
+        self.assertEqual(normalize_phone('+9620790000001'), '962790000001')
+        self.assertEqual(format_national_phone('0790000001'), '+962790000001')
+        self.assertEqual(format_national_phone('790000001'), '+962790000001')
+        self.assertFalse(format_national_phone(''))
+
+        registration = self._create_registrations(1)
+        self.assertEqual(registration.phone_normalized, '962790000000')
+        registration.action_approve()
+        self.assertRecordValues(registration.user_id, [{
+            'mobile': '962790000000',
+            'phone_normalized': '962790000000',
+        }])
+        self.assertFalse(self.referrer.phone_normalized)
+
+    def test_06_duplicate_phone_rejected(self):
+        self._create_registrations(1)
+        with mute_logger('odoo.sql_db'), self.assertRaises(IntegrityError), self.env.cr.savepoint():
+            self.TeamRegistration.create({
+                'name': 'Same Applicant',
+                'phone': '00962 790 000 000',
+                'password': 'applicant.password',
+                'role': 'coach',
+            })
+        # Typed with the national trunk "0", still the same number
+        with mute_logger('odoo.sql_db'), self.assertRaises(IntegrityError), self.env.cr.savepoint():
+            self.TeamRegistration.create({
+                'name': 'Same Applicant',
+                'phone': '+962 0790 000 000',
+                'password': 'applicant.password',
+                'role': 'coach',
+            })
+
+    def test_07_certificate_in_filestore(self):
+        registration, other = self._create_registrations(2)
+        registration._attach_certificate('certificate.pdf', b'%PDF certificate')
+        other.cert_file = base64.b64encode(b'%PDF certificate')
+
+        attachments = self.env['ir.attachment'].sudo().search([
+            ('res_model', '=', 'team.registration'),
+            ('res_field', '=', 'cert_file'),
+            ('res_id', 'in', (registration | other).ids),
+        ])
+        self.assertEqual(len(attachments), 2)
+        self.assertEqual(len(set(attachments.mapped('store_fname'))), 1, "Same content, one blob")
+        self.assertEqual(registration.cert_filename, 'certificate.pdf')
+        self.assertEqual(base64.b64decode(registration.cert_file), b'%PDF certificate')
+        self.assertEqual(attachments.mapped('file_size'), [16, 16])
+
+    def test_08_certificate_size_cap(self):
+        registration = self._create_registrations(1)
+        with patch('odoo.addons.team_registration.models.team_registration.CERT_MAX_SIZE', 8):
+            with self.assertRaises(ValidationError):
+                registration._attach_certificate('big.pdf', b'123456789')
+            with self.assertRaises(ValidationError):
+                registration.cert_file = base64.b64encode(b'123456789')
+            registration.cert_file = base64.b64encode(b'12345678')
+
+    def test_09_failed_approval_does_not_block_queue(self):
+        registrations = self._create_registrations(3)
+        # The login of the second registration is already taken
+        self.env['res.users'].with_context(no_reset_password=True).create({
+            'name': 'Existing Phone User',
+            'login': registrations[1].phone,
+        })
+        with patch.object(type(self.TeamRegistration), '_approval_sync_limit', 1):
+            registrations.action_approve()
+
+        with mute_logger('odoo.sql_db', 'odoo.addons.team_registration.models.team_registration'):
+            self.TeamRegistration._cron_approve_registrations(batch_size=3)
+        self.assertEqual(registrations.mapped('state'), ['approved', 'error', 'approved'])
+        self.assertTrue(registrations[1].approval_error)
+        self.assertFalse(registrations[1].user_id)
+        self.assertEqual(len((registrations[0] | registrations[2]).user_id), 2)
+        self.assertFalse(self.TeamRegistration.search_count([('state', '=', 'approving')]))
@@ -1,5 +1,5 @@
 from odoo.tests import tagged, TransactionCase
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
 from datetime import datetime, timedelta
 import logging
 
@@ -330,4 +330,226 @@ class TestUserCommissionTrack(TransactionCase):
         expected_balance = max(total_commission - total_transferred, 0.0)
 
         # Expected: (1000 + 1500 + 500) - (200 + 300 + 100) = 2400
-        self.assertEqual(expected_balance, 2400.0)
\ No newline at end of file
+        self.assertEqual(expected_balance, 2400.0)
+
+    def test_15_coach_balance_follows_tracks(self):
+        """Test that the stored coach balance follows closing and transfers"""
+        self.commission_track.write({'commission': 1000.0, 'commission_transferred': 300.0})
+        self.assertEqual(self.coach_user.commission_closed_total, 1000.0)
+        self.assertEqual(self.coach_user.commission_transferred_total, 300.0)
+        self.assertEqual(self.coach_user.commission_balance, 700.0)
+        self.assertEqual(self.commission_track.current_balance, 700.0)
+
+        active_track = self.UserCommissionTrack.create({
+            'user_id': self.coach_user.id,
+            'seq': 2,
+            'start_date': self.close_date + timedelta(days=1),
+            'close_date': self.close_date + timedelta(days=90),
+            'status': 'active',
+        })
+        active_track.write({'commission': 500.0})
+        self.assertEqual(self.coach_user.commission_balance, 700.0)
+
+        active_track.write({'status': 'closed'})
+        active_track.write({'commission': 500.0})
+        self.assertEqual(self.coach_user.commission_balance, 1200.0)
+        self.assertEqual(active_track.current_balance, 1200.0)
+
+    def test_16_cron_rollover_chunks_and_partitions(self):
+        """Test that the rollover cron works in chunks and by coach partition"""
+        coaches = self.coach_user
+        for idx in range(3):
+            coaches |= self.ResUsers.create({
+                'name': 'Rollover Coach %s' % idx,
+                'login': 'rollover.coach.%s@example.com' % idx,
+                'is_coach': True,
+            })
+        expired = self.UserCommissionTrack.browse()
+        for coach in coaches:
+            expired |= self.UserCommissionTrack.create({
+                'user_id': coach.id,
+                'seq': 5,
+                'start_date': self.start_date,
+                'close_date': self.close_date,
+                'status': 'active',
+            })
+
+        even = expired.filtered(lambda t: t.user_id.id % 2 == 0)
+        odd = expired - even
+        self.UserCommissionTrack.cron_process_commission_tracks(chunk_size=1, partition=0, partitions=2)
+        self.assertEqual(set(even.mapped('status')), {'closed'} if even else set())
+        self.assertEqual(set(odd.mapped('status')), {'active'} if odd else set())
+
+        self.UserCommissionTrack.cron_process_commission_tracks(chunk_size=1, partition=1, partitions=2)
+        self.assertEqual(set(expired.mapped('status')), {'closed'})
+        for coach in coaches:
+            next_track = self.UserCommissionTrack.search([
+                ('user_id', '=', coach.id),
+                ('seq', '=', 6),
+                ('status', '=', 'active'),
+            ])
+            self.assertEqual(len(next_track), 1)
+
+    def test_17_cron_auto_topup_credits_in_bulk(self):
+        """Test that the bulk top-up credits cards, history and tracks"""
+        ewallet_program = self.LoyaltyProgram.search([('program_type', '=', 'ewallet')], limit=1)
+        if not ewallet_program:
+            ewallet_program = self.LoyaltyProgram.create({
+                'name': 'eWallet Test',
+                'program_type': 'ewallet',
+            })
+        other_coach = self.ResUsers.create({
+            'name': 'Top-up Coach',
+            'login': 'topup.coach@example.com',
+            'is_coach': True,
+        })
+        other_track = self.UserCommissionTrack.create({
+            'user_id': other_coach.id,
+            'seq': 1,
+            'start_date': self.start_date,
+            'close_date': self.close_date,
+            'status': 'closed',
+        })
+        self.commission_track.write({'commission': 150.0, 'commission_transferred': 50.0})
+        other_track.write({'commission': 80.0})
+
+        self.UserCommissionTrack.cron_auto_commission_topup()
+
+        for coach, track, credited in [(self.coach_user, self.commission_track, 100.0),
+                                       (other_coach, other_track, 80.0)]:
+            card = self.LoyaltyCard.search([
+                ('partner_id', '=', coach.partner_id.id),
+                ('program_id', '=', ewallet_program.id),
+            ])
+            self.assertEqual(len(card), 1)
+            self.assertEqual(card.points, credited)
+            history = self.env['loyalty.history'].search([('card_id', '=', card.id)])
+            self.assertEqual(history.mapped('issued'), [credited])
+            self.assertEqual(track.commission_transferred, track.commission)
+            self.assertEqual(coach.commission_balance, 0.0)
+
+        # Nothing left to transfer: a second run changes nothing
+        self.UserCommissionTrack.cron_auto_commission_topup()
+        self.assertEqual(self.env['loyalty.history'].search_count([
+            ('card_id.partner_id', 'in', (self.coach_user | other_coach).partner_id.ids),
+        ]), 2)
+
+    def test_18_wallet_program_and_cards_cached(self):
+        """Test the cached eWallet program and the batch wallet card lookup"""
+        Program = self.LoyaltyProgram
+        Card = self.LoyaltyCard
+        ewallet_program = Program._get_ewallet_program()
+        if not ewallet_program:
+            ewallet_program = Program.create({
+                'name': 'eWallet Test',
+                'program_type': 'ewallet',
+            })
+        self.assertEqual(Program._get_ewallet_program(), ewallet_program)
+
+        partners = (self.coach_user | self.referred_user1).partner_id
+        self.assertFalse(Card._get_wallet_cards(partners.ids))
+        cards = Card._get_wallet_cards(partners.ids + partners.ids, create=True)
+        self.assertEqual(set(cards), set(partners.ids))
+        self.assertEqual(Card.search_count([
+            ('partner_id', 'in', partners.ids),
+            ('program_id', '=', ewallet_program.id),
+        ]), 2)
+
+        with self.assertQueryCount(0):
+            Program._get_ewallet_program()
+            self.assertEqual(Card._get_wallet_cards(partners.ids, create=True), cards)
+
+        cards[self.coach_user.partner_id.id].unlink()
+        self.assertEqual(set(Card._get_wallet_cards(partners.ids)), {self.referred_user1.partner_id.id})
+
+        # Coupon cards come and go with the carts, the cache stays
+        coupon = Card.create({
+            'program_id': Program.create({'name': 'Coupons Test', 'program_type': 'coupons'}).id,
+            'partner_id': self.coach_user.partner_id.id,
+        })
+        coupon.write({'partner_id': self.referred_user1.partner_id.id})
+        coupon.unlink()
+        with self.assertQueryCount(0):
+            Program._get_ewallet_program()
+            Card._get_wallet_cards(partners.ids)
+
+        ewallet_program.action_archive()
+        self.assertNotEqual(Program._get_ewallet_program(), ewallet_program)
+
+    def test_19_topup_spread_and_idempotent(self):
+        """Test the locked top-up: oldest tracks first, replayed once per key"""
+        if not self.LoyaltyProgram._get_ewallet_program():
+            self.LoyaltyProgram.create({
+                'name': 'eWallet Test',
+                'program_type': 'ewallet',
+            })
+        Topup = self.env['user.commission.topup']
+        older_track = self.UserCommissionTrack.create({
+            'user_id': self.coach_user.id,
+            'seq': 0,
+            'start_date': self.start_date - timedelta(days=60),
+            'close_date': self.start_date - timedelta(days=1),
+            'status': 'closed',
+        })
+        older_track.write({'commission': 60.0})
+        self.commission_track.write({'commission': 40.0})
+
+        with self.assertRaises(UserError):
+            Topup._topup(self.coach_user, 150.0, 'key-1')
+        self.assertFalse(Topup.search([('user_id', '=', self.coach_user.id)]))
+
+        result = Topup._topup(self.coach_user, 70.0, 'key-1')
+        self.assertEqual(older_track.commission_transferred, 60.0)
+        self.assertEqual(self.commission_track.commission_transferred, 10.0)
+        self.assertEqual(self.coach_user.commission_balance, 30.0)
+        card = self.LoyaltyCard._get_wallet_cards([self.coach_user.partner_id.id])[self.coach_user.partner_id.id]
+        self.assertEqual(card.points, 70.0)
+        self.assertEqual(result, {
+            'amount': 70.0, 'new_balance': 30.0, 'wallet_balance': 70.0, 'replayed': False,
+        })
+
+        # Same key again: nothing is credited twice
+        self.assertEqual(Topup._topup(self.coach_user, 70.0, 'key-1'), dict(result, replayed=True))
+        self.assertEqual(card.points, 70.0)
+        self.assertEqual(self.env['loyalty.history'].search_count([('card_id', '=', card.id)]), 1)
+        with self.assertRaises(UserError):
+            Topup._topup(self.coach_user, 20.0, 'key-1')
+
+        Topup._topup(self.coach_user, 30.0, 'key-2')
+        self.assertEqual(self.commission_track.commission_transferred, 40.0)
+        self.assertEqual(self.coach_user.commission_balance, 0.0)
+        self.assertEqual(card.points, 100.0)
+        with self.assertRaises(UserError):
+            Topup._topup(self.coach_user, 1.0, 'key-3')
+        # No key, no top-up: a retry could not be told from a new request
+        with self.assertRaises(UserError):
+            Topup._topup(self.coach_user, 1.0, None)
+
+    def test_20_closed_tracks_frozen(self):
+        """Test that closing freezes the figures until an explicit recompute"""
+        self.commission_track.write({'commission': 123.0, 'total_purchase': 2460.0})
+
+        # Neither a recompute, a transfer nor a referral change touch it
+        self.commission_track._recompute_purchases()
+        self.commission_track.write({'commission_transferred': 23.0})
+        self.referred_user1.referred_by = False
+        self.env['user.commission.queue']._process_queue()
+        self.assertRecordValues(self.commission_track, [{'commission': 123.0, 'total_purchase': 2460.0}])
+        self.assertEqual(self.coach_user.commission_balance, 100.0)
+
+        # Closing an expired active track freezes what it computed last
+        active_track = self.UserCommissionTrack.create({
+            'user_id': self.coach_user.id,
+            'seq': 2,
+            'start_date': self.start_date,
+            'close_date': self.close_date,
+            'status': 'active',
+        })
+        self.assertEqual(active_track.status, 'closed')
+        next_track = self.UserCommissionTrack.search([('user_id', '=', self.coach_user.id), ('seq', '=', 3)])
+        self.assertEqual(next_track.status, 'active')
+
+        # The admin correction recomputes them from the ledger, still closed
+        (self.commission_track | active_track | next_track).action_reopen_and_recompute()
+        self.assertRecordValues(self.commission_track, [{'commission': 0.0, 'total_purchase': 0.0, 'status': 'closed'}])
+        self.assertEqual(self.coach_user.commission_balance, 0.0)